@@ -0,0 +1,117 @@
+from . import models
+from .regions import REGIONS
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+import calendar
+import datetime
+import json
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def to_epoch(t):
+    """
+        Seconds since the epoch, naive datetimes are assumed to be UTC.
+    """
+    return calendar.timegm(t.utctimetuple())
+
+
+def compile_rules(availability_rules):
+    """
+        Turn a pokemons JSON availability rules into a list of
+        (start, end, regions) rulesets, where start and end are epoch
+        seconds. Returns None if the pokemon has no rules at all.
+
+        A pokemon is available if any ruleset matches, and a ruleset
+        matches if the time is within start and end, and the location
+        is inside every region.
+    """
+    rules = json.loads(availability_rules) if availability_rules is not None else None
+    if rules is None:
+        return None
+    rulesets = []
+    for ruleset in rules:
+        start = float("-inf")
+        end = float("inf")
+        regions = []
+        possible = True
+        for rule in ruleset:
+            if rule["type"] == "time":
+                start = max(start, to_epoch(datetime.datetime.strptime(rule["start"], TIME_FORMAT)))
+                end = min(end, to_epoch(datetime.datetime.strptime(rule["end"], TIME_FORMAT)))
+            elif rule["type"] == "region":
+                if "region" not in rule or rule["region"] not in REGIONS:
+                    # An unknown region can never match.
+                    possible = False
+                    break
+                regions.append(rule["region"])
+        if possible and start <= end:
+            rulesets.append((start, end, tuple(regions)))
+    return rulesets
+
+
+def is_available(rulesets, raid_level, epoch, in_region):
+    """
+        Check compiled rulesets, in_region is called with a region name
+        and returns whether the location is inside it.
+    """
+    if rulesets is None:
+        return bool(raid_level)
+    for start, end, regions in rulesets:
+        if start <= epoch <= end and all(in_region(region) for region in regions):
+            return True
+    return False
+
+
+# Pokemon changes that invalidate the index.
+EVENTS = ["after_insert", "after_update", "after_delete"]
+
+
+class AvailabilityIndex:
+    """
+        Compiled availability rules for every raid boss, indexed by
+        (level, ex). Rebuilt on the next lookup after the pokemon table
+        changes.
+
+        The pokemon are kept as detached copies, so commits on the cogs
+        session don't expire them, and merged into the session they're
+        returned to without a query.
+    """
+    def __init__(self):
+        self.by_level = {}
+        self.dirty = True
+        for name in EVENTS:
+            event.listen(models.Pokemon, name, self.invalidate)
+
+    def stop(self):
+        for name in EVENTS:
+            event.remove(models.Pokemon, name, self.invalidate)
+
+    def invalidate(self, *args):
+        self.dirty = True
+
+    def load(self, session):
+        by_level = {}
+        rows = session.query(models.Pokemon.__table__).filter(
+            models.Pokemon.raid_level != None
+        ).order_by("name")
+        for row in rows:
+            pokemon = models.Pokemon(**row._asdict())
+            make_transient_to_detached(pokemon)
+            key = (pokemon.raid_level, bool(pokemon.ex))
+            by_level.setdefault(key, []).append((pokemon, compile_rules(pokemon.availability_rules)))
+        self.by_level = by_level
+        self.dirty = False
+
+    def possible(self, session, regions, time, level, ex):
+        """
+            Pokemon that can appear at level / ex, for a gym in regions
+            (see regions.RegionClassifier) at time.
+        """
+        if self.dirty:
+            self.load(session)
+        epoch = to_epoch(time)
+        return [
+            session.merge(pokemon, load=False) for pokemon, rulesets in self.by_level.get((level, bool(ex)), [])
+            if is_available(rulesets, level, epoch, regions.__contains__)
+        ]
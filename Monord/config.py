@@ -115,41 +115,66 @@ async def list_settings(ctx):
     embed=discord.Embed(title=_("Settings"), description="\n".join(msg))
     await ctx.send(embed=embed)
 
+# Resolved GuildConfig rows, keyed by (guild_id, channel_id). A channel_id of
+# None holds the server wide settings. Missing rows are cached as None so we
+# don't keep querying for channels that have never been configured.
+_cache = {}
+_cache_hits = 0
+_cache_misses = 0
+
+def cache_info():
+    return {"hits": _cache_hits, "misses": _cache_misses, "size": len(_cache)}
+
+def invalidate(guild_id=None, channel_id=None):
+    """
+        Drop cached settings, either for a single guild/channel
+        pair or for everything when called without arguments
+    """
+    if guild_id is None and channel_id is None:
+        _cache.clear()
+        return
+    _cache.pop((guild_id, channel_id), None)
+
+def _row_to_dict(cfg):
+    if cfg is None:
+        return None
+    return {key: getattr(cfg, key) for key in SETTINGS}
+
+def _get_row(session, guild_id, channel_id):
+    global _cache_hits, _cache_misses
+    key = (guild_id, channel_id)
+    if key in _cache:
+        _cache_hits += 1
+        return _cache[key]
+    _cache_misses += 1
+    cfg = session.query(models.GuildConfig).filter(
+        models.GuildConfig.guild_id == guild_id,
+        models.GuildConfig.channel_id == channel_id
+    ).first()
+    _cache[key] = _row_to_dict(cfg)
+    return _cache[key]
+
 def get(session, keys, channel, allow_fallback=True, server_only=False, return_default=True):
     if isinstance(keys, str):
         keys = [keys]
 
+    server_cfg = None
+    channel_cfg = None
     if allow_fallback:
-        cfg = session.query(models.GuildConfig).filter(
-            or_(
-                models.GuildConfig.channel_id == channel.id,
-                and_(models.GuildConfig.guild_id == channel.guild.id, models.GuildConfig.channel_id == None)
-            )
-        )
+        server_cfg = _get_row(session, channel.guild.id, None)
+        channel_cfg = _get_row(session, channel.guild.id, channel.id)
     elif server_only:
-        cfg = session.query(models.GuildConfig).filter(
-            models.GuildConfig.guild_id == channel.guild.id,
-            models.GuildConfig.channel_id == None
-        )
+        server_cfg = _get_row(session, channel.guild.id, None)
     else:
-        cfg = session.query(models.GuildConfig).filter(models.GuildConfig.channel_id == channel.id)
+        channel_cfg = _get_row(session, channel.guild.id, channel.id)
 
     result = []
-    server_cfg = None
-    channel_cfg = None
-    if cfg.count() == 1: # One config, use what we have
-        server_cfg = cfg[0] if cfg[0].channel_id is None else None
-        channel_cfg = None if cfg[0].channel_id is None else cfg[0]
-    elif cfg.count() == 2: # Both configs, use best
-        server_cfg = cfg[0] if cfg[0].channel_id is None else cfg[1]
-        channel_cfg = cfg[1] if cfg[0].channel_id is None else cfg[0]
-
     for key in keys:
-        if channel_cfg is not None and getattr(channel_cfg, key) is not None:
-            result.append(getattr(channel_cfg, key))
+        if channel_cfg is not None and channel_cfg[key] is not None:
+            result.append(channel_cfg[key])
             continue
-        if server_cfg is not None and getattr(server_cfg, key) is not None:
-            result.append(getattr(server_cfg, key))
+        if server_cfg is not None and server_cfg[key] is not None:
+            result.append(server_cfg[key])
             continue
         if return_default:
             result.append(SETTINGS[key]["default"])
@@ -158,10 +183,10 @@ def get(session, keys, channel, allow_fallback=True, server_only=False, return_d
     return result if len(result) > 1 else result[0]
 
 def set_guild_config(session, guild, key, value):
-    _set_config(session, key, value, False, **{"guild_id": guild.id, "channel_id": None})
+    return _set_config(session, key, value, False, **{"guild_id": guild.id, "channel_id": None})
 
 def set_channel_config(session, channel, key, value):
-    _set_config(session, key, value, True, **{"guild_id": channel.guild.id, "channel_id": channel.id})
+    return _set_config(session, key, value, True, **{"guild_id": channel.guild.id, "channel_id": channel.id})
 
 def _set_config(session, key, value, is_channel, **kwargs):
     if key not in SETTINGS:
@@ -177,3 +202,5 @@ def _set_config(session, key, value, is_channel, **kwargs):
     setattr(config, key, value)
     session.add(config)
     session.commit()
+    _cache[(kwargs["guild_id"], kwargs["channel_id"])] = _row_to_dict(config)
+    return config
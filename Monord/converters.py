@@ -2,11 +2,12 @@ from . import es_models
 from . import config
 from . import utils
 from . import models
-from elasticsearch_dsl import Search
+from . import search
 from sqlalchemy.orm.exc import NoResultFound
 from discord.ext import commands
 from geoalchemy2.shape import to_shape
 import elasticsearch
+import asyncio
 import re
 import datetime
 import logging
@@ -27,12 +28,14 @@ logger.addHandler(ch)
 RE_MINUTESAFTER = re.compile("^(\d+)@(.+)$")
 RE_DISCORD_MENTION = re.compile("\<@(?:\!|)(\d+)\>")
 
-def get_es_gym_by_id(ctx, argument):
+async def get_es_gym_by_id(ctx, argument):
     try:
-        gym = es_models.Gym.get(id=argument)
+        gym = await search.get_gym(argument)
         return gym
     except elasticsearch.exceptions.NotFoundError:
         raise commands.CommandError(_("Gym with id {} not found").format(argument))
+    except asyncio.TimeoutError:
+        raise commands.CommandError(_("Gym search timed out, try again later"))
 
 
 class Gym(commands.Converter):
@@ -44,24 +47,32 @@ class Gym(commands.Converter):
                         guild_id=ctx.message.channel.guild.id,
                         title=argument.lower()
                     ).one()
-                    return get_es_gym_by_id(ctx, alias.gym.id)
+                    return await get_es_gym_by_id(ctx, alias.gym.id)
                 except NoResultFound:
                     pass
             if argument.isnumeric():
-                return get_es_gym_by_id(ctx, argument)
+                return await get_es_gym_by_id(ctx, argument)
 
             region = config.get(ctx.cog.session, "region", ctx.message.channel)
             if region is None:
                 raise commands.CommandError(_("This guild/channel does not have a region set"))
 
+            if ctx.cog.matcher.loaded:
+                match = ctx.cog.matcher.find_gym(argument, region)
+                if match is not None:
+                    id, title, latitude, longitude = match
+                    return es_models.Gym(meta={'id': id}, title=title, location={"lat": latitude, "lon": longitude})
+                if not search.ES_FALLBACK:
+                    raise commands.CommandError(_("Gym \"{}\" not found").format(argument))
+
             region = to_shape(region)
             points = []
             for point in region.exterior.coords:
                 points.append({"lat": point[1], "lon": point[0]})
-            s = Search(index="gym").query("match", title={'query': argument, 'fuzziness': 2})
-            s = s.filter("geo_polygon", location={"points": points})
-            s.doc_type(es_models.Gym)
-            response = s.execute()
+            try:
+                response = await search.find_gyms(argument, points)
+            except asyncio.TimeoutError:
+                raise commands.CommandError(_("Gym search timed out, try again later"))
             if response.hits.total == 0:
                 raise commands.CommandError(_("Gym \"{}\" not found").format(argument))
             return response[0]
@@ -156,8 +167,17 @@ class Pokemon(commands.Converter):
                 if not 0 < int(argument) < 6:
                     raise commands.CommandError(_("{} is not a valid egg level, must be between 1 and 5").format(argument))
                 return int(argument)
-            s = Search(index="pokemon").query("match", name={'query': argument, 'fuzziness': 2})
-            response = s.execute()
+            if ctx.cog.matcher.loaded:
+                match = ctx.cog.matcher.find_pokemon(argument)
+                if match is not None:
+                    id, name = match
+                    return es_models.Pokemon(meta={'id': id}, name=name)
+                if not search.ES_FALLBACK:
+                    raise commands.CommandError(_("Pokemon \"{}\" not found").format(argument))
+            try:
+                response = await search.find_pokemon(argument)
+            except asyncio.TimeoutError:
+                raise commands.CommandError(_("Pokemon search timed out, try again later"))
             if response.hits.total == 0:
                 raise commands.CommandError(_("Pokemon \"{}\" not found").format(argument))
             return response[0]
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from os import environ
+import asyncio
+import threading
+import time
+
+# Threads available for running database work off the event loop.
+DB_WORKERS = int(environ.get('DB_WORKERS') or 4)
+
+
+class Database:
+    """
+        Runs units of ORM work on a bounded thread pool. Each unit gets
+        its own session from the pooled engine, which is committed when
+        the unit returns and rolled back if it raises.
+
+        Sessions don't expire on commit, so objects returned from a unit
+        can still be read on the event loop, but they are detached and
+        must not be added to the cogs session.
+    """
+    def __init__(self, connection_string, workers=DB_WORKERS):
+        self.engine = create_engine(
+            connection_string,
+            connect_args={"options": "-c timezone=utc"},
+            # One connection per worker, plus the cogs own session.
+            pool_size=workers + 1,
+            max_overflow=2
+        )
+        self.sessionmaker = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    async def run(self, func, *args):
+        """
+            Run func(session, *args) on the pool and return its result.
+        """
+        submitted = time.monotonic()
+        with self.lock:
+            self.queued += 1
+
+        def unit():
+            started = time.monotonic()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_total += started - submitted
+                self.wait_max = max(self.wait_max, started - submitted)
+            session = self.sessionmaker()
+            failed = False
+            try:
+                result = func(session, *args)
+                session.commit()
+                return result
+            except Exception:
+                failed = True
+                session.rollback()
+                raise
+            finally:
+                session.close()
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.errors += failed
+                    self.run_total += time.monotonic() - started
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, unit)
+
+    def info(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "errors": self.errors,
+                "wait_total": self.wait_total,
+                "wait_max": self.wait_max,
+                "run_total": self.run_total
+            }
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+logger = logging.getLogger()
+
+# Discord allows 50 requests per second per bot, keep well under it so
+# that reactions and edits from other handlers still get through.
+MAX_CONCURRENT_REQUESTS = 25
+
+BUCKET_MESSAGES = "messages"
+BUCKET_REACTIONS = "reactions"
+
+
+class Dispatcher:
+    """
+        Spreads Discord requests across channels.
+
+        Discord rate limits message and reaction routes per channel, so
+        work is keyed by (route, channel_id). Work that shares a bucket is
+        run one at a time, everything else runs concurrently up to
+        MAX_CONCURRENT_REQUESTS. A bucket's lock is dropped once nothing
+        is using or waiting on it.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # key -> [lock, jobs using or waiting on it]
+        self.buckets = {}
+        self.latencies = {}
+        self.tasks = set()
+
+    async def run(self, key, coro):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [asyncio.Lock(), 0]
+        bucket[1] += 1
+        try:
+            async with bucket[0]:
+                async with self.semaphore:
+                    return await coro
+        finally:
+            bucket[1] -= 1
+            if bucket[1] == 0:
+                del self.buckets[key]
+
+    async def fan_out(self, jobs, route=BUCKET_MESSAGES):
+        """
+            Run a list of (channel, coroutine) jobs concurrently and
+            return how long each channel took, in seconds. Like
+            utils.wait_for_tasks, the first exception is raised once
+            every job has finished.
+        """
+        latencies = {}
+
+        async def timed(channel, coro):
+            start = time.monotonic()
+            try:
+                await self.run((route, channel.id), coro)
+            finally:
+                latencies[channel.id] = time.monotonic() - start
+
+        if len(jobs) == 0:
+            return latencies
+        start = time.monotonic()
+        done, pending = await asyncio.wait(
+            [self.loop.create_task(timed(channel, coro)) for channel, coro in jobs],
+            return_when=asyncio.ALL_COMPLETED
+        )
+        self.latencies.update(latencies)
+        logger.debug("Fanned out to {} channels in {:.2f}s, slowest {:.2f}s".format(
+            len(jobs), time.monotonic() - start, max(latencies.values())
+        ))
+        for task in done:
+            task.result()
+        return latencies
+
+    def background(self, key, coro):
+        """
+            Queue work on a bucket without waiting for it, used so that
+            reactions don't hold up the messages being sent elsewhere.
+        """
+        task = self.loop.create_task(self.run(key, coro))
+        self.tasks.add(task)
+        task.add_done_callback(self._log_failure)
+        return task
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def _log_failure(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error in background dispatch", exc_info=task.exception())
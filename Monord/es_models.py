@@ -14,8 +14,6 @@ class Gym(DocType):
     class Index:
         name = 'gym'
 
-Gym.init()
-
 
 class Pokemon(DocType):
     name = Text(analyzer='snowball', fields={'raw': Keyword()})
@@ -26,8 +24,6 @@ class Pokemon(DocType):
     class Index:
         name = 'pokemon'
 
-Pokemon.init()
-
 
 class Pokestop(DocType):
     name = Text(analyzer='snowball', fields={'raw': Keyword()})
@@ -38,4 +34,11 @@ class Pokestop(DocType):
     class Index:
         name = 'pokestop'
 
-Pokestop.init()
+
+def init():
+    """
+        Create the indexes and their mappings if they don't exist yet.
+    """
+    Gym.init()
+    Pokemon.init()
+    Pokestop.init()
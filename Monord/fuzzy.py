@@ -0,0 +1,196 @@
+from . import models
+from geoalchemy2.shape import to_shape
+from shapely.geometry import Point
+from shapely.prepared import prep
+import re
+
+RE_TOKEN = re.compile(r"\w+")
+
+# Score given to a query word matching a name word at each edit distance.
+DISTANCE_SCORES = {0: 1.0, 1: 0.8, 2: 0.6}
+
+
+def tokenize(text):
+    return RE_TOKEN.findall(text.lower())
+
+
+def max_distance(token):
+    """
+        Edit distance allowed for a query word, short words would match
+        almost anything with a distance of 2.
+    """
+    if len(token) <= 2:
+        return 0
+    if len(token) <= 4:
+        return 1
+    return 2
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """
+        Finds every word within an edit distance of a query word without
+        comparing against all of them.
+    """
+    def __init__(self):
+        self.root = None
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word, distance):
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_word, children = stack.pop()
+            d = levenshtein(word, node_word)
+            if d <= distance:
+                results.append((node_word, d))
+            for child_distance, child in children.items():
+                if d - distance <= child_distance <= d + distance:
+                    stack.append(child)
+        return results
+
+
+class FuzzyIndex:
+    """
+        Word level fuzzy matching, similar to an Elasticsearch match
+        query with fuzziness. Each query word scores against the closest
+        word in a name, names with fewer words win ties.
+    """
+    def __init__(self):
+        self.names = {}
+        self.postings = {}
+        self.tree = BKTree()
+
+    def add(self, id, name):
+        self.remove(id)
+        tokens = tokenize(name)
+        self.names[id] = (name, len(tokens))
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                self.tree.add(token)
+            self.postings[token].add(id)
+
+    def remove(self, id):
+        if id not in self.names:
+            return
+        name, length = self.names.pop(id)
+        for token in tokenize(name):
+            self.postings.get(token, set()).discard(id)
+
+    def search(self, query, limit=1):
+        scores = {}
+        for token in tokenize(query):
+            best = {}
+            for word, distance in self.tree.search(token, max_distance(token)):
+                for id in self.postings[word]:
+                    best[id] = max(best.get(id, 0), DISTANCE_SCORES[distance])
+            for id, score in best.items():
+                scores[id] = scores.get(id, 0) + score
+        ranked = sorted(scores, key=lambda id: (-scores[id], self.names[id][1], self.names[id][0]))
+        return ranked[:limit]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Matcher:
+    """
+        In process fuzzy search for gyms and pokemon. Gym searches are
+        limited to a guild/channel region, each region gets its own
+        index which is built the first time it's searched.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.gyms = {}
+        self.gym_partitions = {}
+        self.pokemon = FuzzyIndex()
+
+    def add_gym(self, id, title, latitude, longitude):
+        self.gyms[id] = (title, latitude, longitude)
+        point = Point(longitude, latitude)
+        for region, index in self.gym_partitions.values():
+            if region.contains(point):
+                index.add(id, title)
+            else:
+                index.remove(id)
+
+    def remove_gym(self, id):
+        self.gyms.pop(id, None)
+        for region, index in self.gym_partitions.values():
+            index.remove(id)
+
+    def add_pokemon(self, id, name):
+        self.pokemon.add(id, name)
+
+    def partition(self, region):
+        key = region.desc
+        if key not in self.gym_partitions:
+            prepared = prep(to_shape(region))
+            index = FuzzyIndex()
+            for id, (title, latitude, longitude) in self.gyms.items():
+                if prepared.contains(Point(longitude, latitude)):
+                    index.add(id, title)
+            self.gym_partitions[key] = (prepared, index)
+        return self.gym_partitions[key][1]
+
+    def find_gym(self, title, region):
+        """
+            Returns (id, title, latitude, longitude) of the best match
+            inside region, or None.
+        """
+        ids = self.partition(region).search(title)
+        if not ids:
+            return None
+        return (ids[0],) + self.gyms[ids[0]]
+
+    def find_pokemon(self, name):
+        """
+            Returns (id, name) of the best match, or None.
+        """
+        ids = self.pokemon.search(name)
+        if not ids:
+            return None
+        return ids[0], self.pokemon.names[ids[0]][0]
+
+
+def build_matcher(session):
+    """
+        Build a Matcher from the database, meant to be run on the
+        database pool and then swapped in.
+    """
+    matcher = Matcher()
+    for gym in session.query(models.Gym):
+        location = to_shape(gym.location)
+        matcher.gyms[gym.id] = (gym.title, location.y, location.x)
+    for pokemon in session.query(models.Pokemon):
+        matcher.pokemon.add(pokemon.id, pokemon.name)
+    matcher.loaded = True
+    return matcher
@@ -0,0 +1,92 @@
+from os import environ
+import math
+
+# A webhook gym within this many metres of a known gym is taken to be
+# that gym, scanners and manual imports rarely agree on exact coordinates.
+SNAP_DISTANCE = float(environ.get('WEBHOOK_SNAP_METRES') or 20)
+METRES_PER_DEGREE = 111320.0
+EARTH_RADIUS = 6371000.0
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    """
+        Metres between two points, an equirectangular approximation which
+        is plenty accurate over a few hundred metres.
+    """
+    x = math.radians(longitude2 - longitude1) * math.cos(math.radians((latitude1 + latitude2) / 2))
+    y = math.radians(latitude2 - latitude1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+
+class GymIndex:
+    """
+        In memory gym locations for resolving scanner gym ids to our own.
+
+        Locations are bucketed into a grid of cells snap_distance high, so
+        finding the nearest gym only looks at the surrounding cells.
+        Resolutions are cached per scanner gym id.
+    """
+    def __init__(self, snap_distance=SNAP_DISTANCE):
+        self.snap_distance = snap_distance
+        self.cell = snap_distance / METRES_PER_DEGREE
+        self.loaded = False
+        self.gyms = {}
+        self.grid = {}
+        self.resolved = {}
+
+    def load(self, gyms):
+        """
+            Replace the index with gyms, a dict of id -> (title, latitude, longitude)
+            as kept by fuzzy.Matcher.
+        """
+        self.gyms = {}
+        self.grid = {}
+        self.resolved = {}
+        for id, (title, latitude, longitude) in gyms.items():
+            self.add(id, latitude, longitude)
+        self.loaded = True
+
+    def cell_of(self, latitude, longitude):
+        return math.floor(latitude / self.cell), math.floor(longitude / self.cell)
+
+    def add(self, id, latitude, longitude):
+        self.remove(id)
+        self.gyms[id] = (latitude, longitude)
+        self.grid.setdefault(self.cell_of(latitude, longitude), set()).add(id)
+
+    def remove(self, id):
+        if id not in self.gyms:
+            return
+        latitude, longitude = self.gyms.pop(id)
+        self.grid.get(self.cell_of(latitude, longitude), set()).discard(id)
+        self.resolved = {key: value for key, value in self.resolved.items() if value != id}
+
+    def nearest(self, latitude, longitude):
+        row, column = self.cell_of(latitude, longitude)
+        # Cells get narrower in metres away from the equator.
+        span = int(math.ceil(1 / max(math.cos(math.radians(latitude)), 0.01)))
+        best, best_distance = None, self.snap_distance
+        for r in range(row - 1, row + 2):
+            for c in range(column - span, column + span + 1):
+                for id in self.grid.get((r, c), ()):
+                    d = distance(latitude, longitude, *self.gyms[id])
+                    if d <= best_distance:
+                        best, best_distance = id, d
+        return best
+
+    def resolve(self, id, latitude=None, longitude=None):
+        """
+            Returns our gym id for a scanner gym, or None if there is no
+            gym with that id or within snap_distance of the location.
+        """
+        if id in self.resolved:
+            return self.resolved[id]
+        if id in self.gyms:
+            match = id
+        elif latitude is None or longitude is None:
+            return None
+        else:
+            match = self.nearest(latitude, longitude)
+        if match is not None:
+            self.resolved[id] = match
+        return match
@@ -0,0 +1,298 @@
+from . import models
+from . import stats
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl.connections import connections
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from os import environ
+import json
+import time
+
+# Rows sent to Postgres (and documents to Elasticsearch) per statement.
+BATCH_SIZE = int(environ.get('IMPORT_BATCH_SIZE') or 1000)
+CHUNK_SIZE = 64 * 1024
+# Characters that can continue a JSON number.
+NUMBER_CHARS = "0123456789+-.eE"
+
+
+def iter_entries(f, chunk_size=CHUNK_SIZE):
+    """
+        Yield the entries of a JSON array one at a time, reading f in
+        chunks rather than loading the whole file into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    expect = "["
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise json.JSONDecodeError("Unexpected end of file", buffer, position)
+            chunk = f.read(chunk_size)
+            buffer = buffer[position:] + chunk
+            position = 0
+            eof = not chunk
+            continue
+        char = buffer[position]
+        if expect == "[":
+            if char != "[":
+                raise json.JSONDecodeError("Expecting '['", buffer, position)
+            position += 1
+            expect = "first"
+        elif char == "]" and expect in ["first", "separator"]:
+            return
+        elif expect == "separator":
+            if char != ",":
+                raise json.JSONDecodeError("Expecting ',' or ']'", buffer, position)
+            position += 1
+            expect = "value"
+        else:
+            try:
+                entry, end = decoder.raw_decode(buffer, position)
+                # A number at the end of the buffer, or followed by more of
+                # a number ("2" of "2.5" split after "2."), may be cut short.
+                complete = eof or (end < len(buffer) and not (
+                    isinstance(entry, (int, float)) and buffer[end] in NUMBER_CHARS
+                ))
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # The entry runs past the end of the buffer, read more.
+                chunk = f.read(chunk_size)
+                buffer = buffer[position:] + chunk
+                position = 0
+                eof = not chunk
+                continue
+            yield entry
+            position = end
+            expect = "separator"
+
+
+def gym_id(data):
+    """
+        Id for a gym that came without one, derived from its location so
+        importing the same file twice updates rather than duplicates.
+    """
+    return "{:.6f},{:.6f}".format(data["latitude"], data["longitude"])
+
+
+def location_key(latitude, longitude):
+    return round(latitude, 6), round(longitude, 6)
+
+
+POKEMON_COLUMNS = ["name", "raid_level", "ex", "availability_rules", "perfect_cp", "perfect_cp_boosted", "shiny", "types"]
+
+
+def pokemon_row(data):
+    """
+        Columns to write for a pokemon entry, types is left out when the
+        entry doesn't have them so the stored types are kept.
+    """
+    row = {
+        "id": int(data["id"]),
+        "name": data["name"],
+        "raid_level": data.get("raid_level", None),
+        "ex": data.get("ex", False),
+        "availability_rules": json.dumps(data.get("availability_rules", None)),
+        "perfect_cp": data.get("perfect_cp", None),
+        "perfect_cp_boosted": data.get("perfect_cp_boosted", None),
+        "shiny": data.get("shiny", False),
+    }
+    if data.get("types", None) is not None:
+        row["types"] = stats.to_int(data["types"])
+    return row
+
+
+class Importer:
+    """
+        Loads gym and pokemon entries in batches, one upsert statement and
+        one Elasticsearch bulk request per batch.
+
+        Gyms without an id are matched to existing gyms by location, as
+        the old importer did. Only the title of an existing gym is
+        updated, pokemon are overwritten by id.
+    """
+    def __init__(self, batch_size=BATCH_SIZE, index=True):
+        self.batch_size = batch_size
+        self.index = index
+        self.session = None
+        self.locations = None
+        self.gyms = {}
+        self.pokemon = {}
+        self.counts = {"gym": 0, "pokemon": 0, "skipped": 0}
+        self.started = None
+        self.finished = None
+
+    def run(self, session, entries):
+        """
+            Import an iterable of entries, committing after each batch.
+        """
+        self.session = session
+        self.started = time.monotonic()
+        if self.locations is None:
+            self.load_locations()
+        for entry in entries:
+            self.add(entry)
+        self.flush()
+        self.finished = time.monotonic()
+        return self
+
+    def run_file(self, session, path):
+        with open(path, "r") as f:
+            return self.run(session, iter_entries(f))
+
+    def load_locations(self):
+        self.locations = {}
+        query = self.session.query(models.Gym.id, func.ST_Y(models.Gym.location), func.ST_X(models.Gym.location))
+        for id, latitude, longitude in query:
+            self.locations[location_key(latitude, longitude)] = id
+
+    def resolve_gym(self, data):
+        key = location_key(data["latitude"], data["longitude"])
+        id = data.get("id") or self.locations.get(key) or gym_id(data)
+        self.locations[key] = id
+        return id
+
+    def add(self, entry):
+        data = entry.get("data", {})
+        if entry.get("type") == "gym":
+            id = self.resolve_gym(data)
+            self.gyms[id] = {
+                "id": id,
+                "title": data["title"],
+                "latitude": data["latitude"],
+                "longitude": data["longitude"],
+                "ex": data.get("ex", False),
+            }
+            if len(self.gyms) >= self.batch_size:
+                self.flush_gyms()
+        elif entry.get("type") == "pokemon":
+            row = pokemon_row(data)
+            # Elasticsearch keeps the id as written in the file ("001").
+            self.pokemon[row["id"]] = (row, data["id"])
+            if len(self.pokemon) >= self.batch_size:
+                self.flush_pokemon()
+        else:
+            self.counts["skipped"] += 1
+
+    def flush(self):
+        self.flush_gyms()
+        self.flush_pokemon()
+
+    def flush_gyms(self):
+        if not self.gyms:
+            return
+        # Sorted so concurrent importers lock rows in the same order.
+        gyms = [self.gyms[id] for id in sorted(self.gyms)]
+        self.gyms = {}
+        stmt = insert(models.Gym.__table__).values([{
+            "id": gym["id"],
+            "title": gym["title"],
+            "location": from_shape(Point(gym["longitude"], gym["latitude"]), srid=4326),
+            "ex": gym["ex"],
+        } for gym in gyms])
+        stmt = stmt.on_conflict_do_update(index_elements=["id"], set_={"title": stmt.excluded.title})
+        self.session.execute(stmt)
+        self.session.commit()
+        if self.index:
+            from . import es_models
+            self.bulk_index(es_models.Gym(
+                meta={'id': gym["id"]},
+                title=gym["title"],
+                location={"lat": gym["latitude"], "lon": gym["longitude"]},
+            ) for gym in gyms)
+        self.counts["gym"] += len(gyms)
+
+    def flush_pokemon(self):
+        if not self.pokemon:
+            return
+        rows = [self.pokemon[id][0] for id in sorted(self.pokemon)]
+        doc_ids = [self.pokemon[id][1] for id in sorted(self.pokemon)]
+        self.pokemon = {}
+        # One statement per set of columns, rows without types don't overwrite them.
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for columns, group in sorted(groups.items()):
+            stmt = insert(models.Pokemon.__table__).values(group)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["id"],
+                set_={key: stmt.excluded[key] for key in columns if key != "id"}
+            )
+            self.session.execute(stmt)
+        self.session.commit()
+        if self.index:
+            from . import es_models
+            self.bulk_index(es_models.Pokemon(meta={'id': doc_id}, name=row["name"]) for row, doc_id in zip(rows, doc_ids))
+        self.counts["pokemon"] += len(rows)
+
+    def diff(self, session, entries):
+        """
+            Compare entries against the database without writing anything.
+
+            Yields (status, kind, id, changes) where status is "new",
+            "changed" or "unchanged" and changes maps each column that
+            would be written to (old, new).
+        """
+        self.session = session
+        if self.locations is None:
+            self.load_locations()
+        existing = {
+            "gym": {id: {"title": title} for id, title in session.query(models.Gym.id, models.Gym.title)},
+            "pokemon": {},
+        }
+        for pokemon in session.query(models.Pokemon):
+            existing["pokemon"][pokemon.id] = {column: getattr(pokemon, column) for column in POKEMON_COLUMNS}
+        for entry in entries:
+            data = entry.get("data", {})
+            kind = entry.get("type")
+            if kind == "gym":
+                id = self.resolve_gym(data)
+                row = {"title": data["title"]}
+            elif kind == "pokemon":
+                row = pokemon_row(data)
+                id = row.pop("id")
+            else:
+                continue
+            old = existing[kind].get(id)
+            existing[kind][id] = row
+            if old is None:
+                yield "new", kind, id, {column: (None, value) for column, value in row.items()}
+                continue
+            changes = {column: (old[column], value) for column, value in row.items() if old[column] != value}
+            yield ("changed" if changes else "unchanged"), kind, id, changes
+
+    def bulk_index(self, docs):
+        bulk(connections.get_connection(), (doc.to_dict(include_meta=True) for doc in docs), chunk_size=self.batch_size)
+
+    def total(self):
+        return self.counts["gym"] + self.counts["pokemon"]
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.total() / elapsed if elapsed else 0.0
+
+    def summary(self):
+        return summary(self.counts, self.elapsed())
+
+
+def summary(counts, elapsed):
+    total = counts["gym"] + counts["pokemon"]
+    return "Imported {} gyms and {} pokemon in {:.1f}s ({:.0f} rows/s)".format(
+        counts["gym"],
+        counts["pokemon"],
+        elapsed,
+        total / elapsed if elapsed else 0.0
+    )
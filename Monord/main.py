@@ -4,17 +4,27 @@ from . import utils
 from . import converters
 from . import config
 from . import timers
-from . import stats
 from . import webhook
+from . import dispatch
+from . import messages
+from . import updates
+from . import render
+from . import availability
+from . import regions
+from . import router
+from . import search
+from . import db
+from . import fuzzy
+from . import importer
+from . import metrics
+from . import roles
+from . import subscriptions
 import asyncio
 from discord.ext import commands
 from elasticsearch import Elasticsearch
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
 from sqlalchemy.orm.exc import NoResultFound
 from os.path import exists as path_exists
-from geoalchemy2.shape import from_shape
-from shapely.geometry import Point
 import time as time_module
 import discord
 import json
@@ -22,8 +32,15 @@ import datetime
 import pytz
 import re
 import gettext
+import logging
 from os import environ
 _ = gettext.gettext
+logger = logging.getLogger()
+
+# Longest wait, in seconds, between attempts to load the matcher.
+MATCHER_RETRY_MAX = 60
+# Attempts the reloadindexes command makes before giving up.
+RELOAD_ATTEMPTS = 3
 
 class Monord(commands.Cog):
     """
@@ -31,20 +48,75 @@ class Monord(commands.Cog):
     """
     def __init__(self, bot):
         self.bot = bot
-        engine = create_engine(environ.get('POSTGRES_CS'), connect_args={"options": "-c timezone=utc"})
-        models.Base.metadata.create_all(engine)
-        self.session = sessionmaker(bind=engine)()
-        self.raid_timers_task = None
-        self.raid_time_stale = False
-        self.embed_timers_task = None
-        self.embed_time_stale = False
-        timers.raid_reschedule(self)
-        timers.embed_reschedule(self)
-        self.webhook = webhook.Webhook(self.bot)
-        self.bot.loop.create_task(self.webhook.webserver())
-
-    def __unload(self):
-        asyncio.ensure_future(self.webhook.site.stop())
+        es_models.init()
+        self.db = db.Database(environ.get('POSTGRES_CS'))
+        models.Base.metadata.create_all(self.db.engine)
+        self.session = sessionmaker(bind=self.db.engine)()
+        self.dispatcher = dispatch.Dispatcher(self.bot.loop)
+        self.messages = messages.MessageCache(self.bot)
+        self.updates = updates.UpdateCoalescer(self)
+        self.raid_bodies = render.RaidBodyCache()
+        self.availability = availability.AvailabilityIndex()
+        self.regions = regions.RegionClassifier()
+        self.router = router.Router()
+        self.router.load(self.session)
+        self.subscriptions = subscriptions.SubscriptionIndex()
+        self.subscriptions.load(self.session)
+        # Message ids of every Embed, so reactions and deletes on other
+        # messages can be ignored without a query.
+        self.tracked_messages = {message_id for message_id, in self.session.query(models.Embed.message_id).filter(
+            models.Embed.embed_type != utils.EMBED_MENTION
+        )}
+        self.matcher = fuzzy.Matcher()
+        self.scheduler = timers.Scheduler(self)
+        self.scheduler.start()
+        self.webhook = webhook.Webhook(self)
+        # Background tasks to cancel when the cog is unloaded.
+        self.tasks = [
+            self.bot.loop.create_task(self.load_matcher()),
+            self.bot.loop.create_task(timers.role_sweeper(self)),
+            self.bot.loop.create_task(self.webhook.webserver())
+        ]
+        metrics.instrument(self)
+
+    async def load_matcher(self, attempts=None):
+        # The webhook won't take events until this succeeds, keep trying
+        # unless attempts is given.
+        delay = 1
+        while True:
+            try:
+                self.matcher = await self.db.run(fuzzy.build_matcher)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if attempts is not None:
+                    attempts -= 1
+                    if attempts <= 0:
+                        raise
+                logger.exception("Error loading the matcher, retrying in {}s".format(delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MATCHER_RETRY_MAX)
+        self.webhook.gyms.load(self.matcher.gyms)
+
+    async def cog_before_invoke(self, ctx):
+        ctx.started_at = time_module.monotonic()
+
+    async def cog_after_invoke(self, ctx):
+        metrics.command_seconds.observe(
+            time_module.monotonic() - ctx.started_at,
+            command=ctx.command.qualified_name,
+            status="error" if ctx.command_failed else "ok"
+        )
+
+    def cog_unload(self):
+        for task in self.tasks:
+            task.cancel()
+        self.scheduler.stop()
+        self.updates.stop()
+        self.dispatcher.stop()
+        self.availability.stop()
+        asyncio.ensure_future(self.webhook.stop())
 
     @commands.group(name="gym", invoke_without_command=True, case_insensitive=True)
     async def gym(self, ctx):
@@ -74,7 +146,10 @@ class Monord(commands.Cog):
             <ex> - Is the gym an EX location (yes/no)
             <title> - The title of the gym
         """
-        gym, gymdoc = utils.add_gym(self.session, id, latitude, longitude, ex, title)
+        gym, gymdoc = await utils.add_gym(self.session, id, latitude, longitude, ex, title)
+        self.regions.forget(gym.id)
+        self.matcher.add_gym(gym.id, title, latitude, longitude)
+        self.webhook.gyms.add(gym.id, latitude, longitude)
         await ctx.send("Gym created", embed=utils.prepare_gym_embed((gymdoc, gym)))
 
     @commands.has_permissions(manage_guild=True)
@@ -171,7 +246,9 @@ class Monord(commands.Cog):
         sql_gym = self.session.query(models.Gym).filter_by(id=gym.meta["id"])
         title = sql_gym.first().title
         sql_gym.delete()
-        es_models.Gym.get(id=gym.meta["id"]).delete()
+        await search.delete_gym(gym.meta["id"])
+        self.matcher.remove_gym(gym.meta["id"])
+        self.webhook.gyms.remove(gym.meta["id"])
         await ctx.send(_("Gym removed"))
 
     @gym.group(name="set", invoke_without_command=True, case_insensitive=True)
@@ -197,11 +274,12 @@ class Monord(commands.Cog):
         sql_gym.title = title
         self.session.add(sql_gym)
         self.session.commit()
-        es_models.Gym(
+        await search.save("gym", es_models.Gym(
             meta={'id': sql_gym.id},
             title=title,
             location={"lat": es_gym.location['lat'], "lon": es_gym.location['lon']},
-        ).save()
+        ))
+        self.matcher.add_gym(sql_gym.id, title, es_gym.location['lat'], es_gym.location['lon'])
         await ctx.tick()
 
     @commands.group(name="raid", invoke_without_command=True, case_insensitive=True)
@@ -239,6 +317,7 @@ class Monord(commands.Cog):
                 raid.pokemon = sql_pokemon
                 self.session.add(raid)
                 self.session.commit()
+                utils.raid_changed(self, raid)
                 return
             await utils.send_raid(self, ctx.message.channel, raid, _("That raid has already been reported"))
             return
@@ -357,7 +436,7 @@ class Monord(commands.Cog):
         raid.despawn_time = time
         self.session.add(raid)
         await utils.update_raid(self, raid)
-        timers.raid_reschedule(self)
+        timers.raid_reschedule(self, raid)
         await ctx.tick()
 
     @raid.command(case_insensitive=True)
@@ -366,20 +445,20 @@ class Monord(commands.Cog):
         raid.despawn_time = time + datetime.timedelta(minutes=utils.DESPAWN_TIME)
         self.session.add(raid)
         await utils.update_raid(self, raid)
-        timers.raid_reschedule(self)
+        timers.raid_reschedule(self, raid)
         await ctx.tick()
 
     @raid.command(case_insensitive=True)
     async def possibilities(self, ctx, *, gym: converters.GymWithSQL):
         es_gym, sql_gym = gym
         now = pytz.utc.localize(datetime.datetime.now())
-        pokemon = utils.get_possible_pokemon(self, sql_gym.location, now, 5, True)
+        pokemon = utils.get_possible_pokemon(self, sql_gym, now, 5, True)
         possibilities = "EX:\n"
         for p in pokemon:
             possibilities += "- " + p.name + "\n"
         possibilities += "\n"
         for i in range(1, 6):
-            pokemon = utils.get_possible_pokemon(self, sql_gym.location, now, i, False)
+            pokemon = utils.get_possible_pokemon(self, sql_gym, now, i, False)
             possibilities += "Level {}\n".format(i)
             for p in pokemon:
                 possibilities += "- " + p.name + "\n"
@@ -397,7 +476,7 @@ class Monord(commands.Cog):
         """
         es_pokemon, sql_pokemon = pokemon
         if isinstance(sql_pokemon, int):
-            pokemons = utils.get_possible_pokemon(self, raid.gym.location, pytz.utc.localize(raid.despawn_time), sql_pokemon, raid.ex)
+            pokemons = utils.get_possible_pokemon(self, raid.gym, pytz.utc.localize(raid.despawn_time), sql_pokemon, raid.ex)
             if len(pokemons) == 1:
                 sql_pokemon = pokemons[0]
         raid.pokemon = sql_pokemon if not isinstance(sql_pokemon, int) else None
@@ -435,11 +514,13 @@ class Monord(commands.Cog):
             value = None
         try:
             if is_channel:
-                config.set_channel_config(self.session, channel, key, value)
+                cfg = config.set_channel_config(self.session, channel, key, value)
                 await ctx.send(_("Setting {} to \"{}\" on {}").format(key, value, channel.mention))
             else:
-                config.set_guild_config(self.session, channel.guild, key, value)
+                cfg = config.set_guild_config(self.session, channel.guild, key, value)
                 await ctx.send(_("Setting {} to \"{}\"").format(key, value))
+            if key in router.KEYS:
+                self.router.refresh(cfg)
         except config.InvalidSettingError:
             await ctx.send(_("{} is not a valid setting").format(key))
         except config.ValidationError as e:
@@ -484,21 +565,21 @@ class Monord(commands.Cog):
 
             <pokemon> the name of the pokemon
         """
-        await utils.subscribe_with_message(ctx, ctx.message.author, pokemon.name)
+        await utils.subscribe_with_message(ctx, subscriptions.KIND_POKEMON, int(pokemon.meta["id"]), pokemon.name)
 
     @subscribe.group(name="ex", case_insensitive=True)
     async def ex_subscribe(self, ctx):
         """
             Subscribe to notifications for raids on EX Eligible gyms
         """
-        await utils.subscribe_with_message(ctx, ctx.message.author, _("EX Eligible"))
+        await utils.subscribe_with_message(ctx, subscriptions.KIND_EX, "", _("EX Eligible"))
 
     @subscribe.group(name="gym", case_insensitive=True)
     async def gym_subscribe(self, ctx, *, gym: converters.Gym):
         """
             Subscribe to notifications for raids on a gym
         """
-        await utils.subscribe_with_message(ctx, ctx.message.author, gym.title)
+        await utils.subscribe_with_message(ctx, subscriptions.KIND_GYM, gym.meta["id"], gym.title)
 
     @commands.group(name="unsubscribe", invoke_without_command=True, case_insensitive=True)
     async def unsubscribe(self, ctx):
@@ -514,21 +595,45 @@ class Monord(commands.Cog):
 
             <pokemon> the name of the pokemon
         """
-        await utils.unsubscribe_with_message(ctx, ctx.message.author, pokemon.name)
+        await utils.unsubscribe_with_message(ctx, subscriptions.KIND_POKEMON, int(pokemon.meta["id"]), pokemon.name)
 
     @unsubscribe.group(name="ex", case_insensitive=True)
     async def ex_unsubscribe(self, ctx):
         """
             Unsubscribe from notifications for raids on EX Eligible gyms
         """
-        await utils.unsubscribe_with_message(ctx, ctx.message.author, _("EX Eligible"))
+        await utils.unsubscribe_with_message(ctx, subscriptions.KIND_EX, "", _("EX Eligible"))
 
     @unsubscribe.group(name="gym", case_insensitive=True)
     async def gym_unsubscribe(self, ctx, *, gym: converters.Gym):
         """
             Unsubscribe from notifications for raids on a gym
         """
-        await utils.unsubscribe_with_message(ctx, ctx.message.author, gym.title)
+        await utils.unsubscribe_with_message(ctx, subscriptions.KIND_GYM, gym.meta["id"], gym.title)
+
+    @commands.has_permissions(manage_guild=True)
+    @subscribe.command(name="import")
+    async def import_subscriptions(self, ctx):
+        """
+            Converts subscription roles in this guild to subscriptions
+        """
+        if not self.matcher.loaded:
+            await ctx.send(_("Gyms and pokemon are still loading, try again in a minute"))
+            return
+        rows = []
+        ex_role = utils.find_role(ctx.guild, _("EX Eligible"))
+        if ex_role:
+            rows.extend((ctx.guild.id, member.id, subscriptions.KIND_EX, "") for member in ex_role.members)
+        for id, (name, length) in self.matcher.pokemon.names.items():
+            role = utils.find_role(ctx.guild, name)
+            if role:
+                rows.extend((ctx.guild.id, member.id, subscriptions.KIND_POKEMON, id) for member in role.members)
+        for id, (title, latitude, longitude) in self.matcher.gyms.items():
+            role = utils.find_role(ctx.guild, title)
+            if role:
+                rows.extend((ctx.guild.id, member.id, subscriptions.KIND_GYM, id) for member in role.members)
+        count = self.subscriptions.subscribe_many(self.session, rows)
+        await ctx.send(_("Imported {} subscriptions").format(count))
 
     @commands.group(invoke_without_command=True, case_insensitive=True)
     async def party(self, ctx):
@@ -605,76 +710,63 @@ class Monord(commands.Cog):
         if not path_exists(csv_path):
             await ctx.send(_("{} File not found").format(csv_path))
             return
-        with open(csv_path, "r") as f:
-            try:
-                data = json.loads(f.read())
-            except json.decoder.JSONDecodeError as e:
-                await ctx.send(e)
-                return
-            message = await ctx.send("Importing data, this will take a second... (0 / {})".format(len(data)))
-            last_time = time_module.time()
-            count_gyms = 0
-            count_pokemon = 0
-            for i, entry in enumerate(data):
-                now = time_module.time()
-                if now - last_time > 5 or i == len(data)-1:
-                    await message.edit(content="Importing data, this will take a second... ({} / {})".format(i+1, len(data)))
-                    last_time = now
-                if entry["type"] == "gym":
-                    count_gyms += 1
-                    try:
-                        gym = self.session.query(models.Gym).filter_by(
-                            location=from_shape(Point(entry["data"]["longitude"], entry["data"]["latitude"]), srid=4326)
-                        ).one()
-                        if gym.title != entry["data"]["title"]:
-                            gym.title = entry["data"]["title"]
-                            self.session.add(gym)
-                    except NoResultFound:
-                        utils.add_gym(
-                            self.session,
-                            entry["data"]["latitude"],
-                            entry["data"]["longitude"],
-                            entry["data"].get("ex", False),
-                            entry["data"]["title"],
-                        )
-                elif entry["type"] == "pokemon":
-                    count_pokemon += 1
-                    try:
-                        p = self.session.query(models.Pokemon).filter_by(name=entry["data"]["name"]).one()
-                    except NoResultFound:
-                        p = models.Pokemon(name=entry["data"]["name"])
-                    p.id = entry["data"]["id"]
-                    p.raid_level = entry["data"].get("raid_level", None)
-                    p.ex = entry["data"].get("ex", False)
-                    p.availability_rules = json.dumps(entry["data"].get("availability_rules", None))
-                    p.perfect_cp = entry["data"].get("perfect_cp", None)
-                    p.perfect_cp_boosted = entry["data"].get("perfect_cp_boosted", None)
-                    p.shiny = entry["data"].get("shiny", False)
-                    if entry["data"].get("types", None) is not None:
-                        p.types = stats.to_int(entry["data"]["types"])
-                    self.session.add(p)
-                    es_models.Pokemon(meta={'id': entry["data"]["id"]}, name=entry["data"]["name"]).save()
-            self.session.commit()
-            await ctx.send("Imported {} gyms and {} pokemon".format(count_gyms, count_pokemon))
+        message = await ctx.send("Importing data, this will take a second...")
+        job = importer.Importer()
+        task = asyncio.ensure_future(self.db.run(job.run_file, csv_path))
+        while not task.done():
+            await asyncio.wait([task], timeout=5)
+            if not task.done():
+                await message.edit(content="Importing data, this will take a second... ({} rows, {:.0f} rows/s)".format(job.total(), job.throughput()))
+        try:
+            task.result()
+        except json.decoder.JSONDecodeError as e:
+            await ctx.send(e)
+            return
+        finally:
+            # In the background, reloading keeps retrying until the database is back.
+            self.tasks.append(self.bot.loop.create_task(self.reload_indexes()))
+        await message.edit(content=job.summary())
 
-    async def on_raw_reaction(self, payload):
-        guild = self.bot.get_guild(payload.guild_id)
-        channel = guild.get_channel(payload.channel_id)
-        member = guild.get_member(payload.user_id)
-        message = await channel.get_message(payload.message_id)
+    @commands.has_permissions(manage_guild=True)
+    @commands.command(name="reloadindexes", case_insensitive=True)
+    async def reload_indexes_command(self, ctx):
+        """
+            Reload gyms and pokemon after an import done with loaddata.py
+        """
+        try:
+            await self.reload_indexes(RELOAD_ATTEMPTS)
+        except Exception as e:
+            await ctx.send(_("Reloading failed: {}").format(e))
+            return
+        await ctx.send(_("Reloaded {} gyms and {} pokemon").format(len(self.matcher.gyms), len(self.matcher.pokemon)))
+
+    async def reload_indexes(self, attempts=None):
+        """
+            Rebuild the in memory gym and pokemon indexes from the database.
+        """
+        self.availability.invalidate()
+        await self.load_matcher(attempts)
 
-        if member == self.bot.user:
+    async def on_raw_reaction(self, payload):
+        """
+            Handle a reaction, returns the raid whose embeds need updating.
+        """
+        if payload.user_id == self.bot.user.id:
             # Ignore reactions that we add
             return
 
-        if message.author != self.bot.user:
-            # Ignore reactions on any messages that weren't created by us
+        if payload.message_id not in self.tracked_messages:
+            # Not one of our raid or hatch messages.
             return
 
-        # Find the Embed associated with our message.
-        try:
-            embed = self.session.query(models.Embed).filter_by(channel_id=channel.id, message_id=message.id).one()
-        except NoResultFound:
+        guild = self.bot.get_guild(payload.guild_id)
+        channel = guild.get_channel(payload.channel_id)
+        member = guild.get_member(payload.user_id)
+
+        # Find the Embed associated with our message, we only have
+        # Embeds for messages that were created by us.
+        embed = await self.db.run(utils.find_embed, channel.id, payload.message_id)
+        if embed is None:
             return
 
         if embed.embed_type == utils.EMBED_RAID:
@@ -691,19 +783,15 @@ class Monord(commands.Cog):
             elif str(payload.emoji) == emoji_remove_person:
                 await utils.add_person(self, member, embed.raid, member, -1)
             elif str(payload.emoji) == emoji_add_time or str(payload.emoji) == emoji_remove_time:
-                if str(payload.emoji) == emoji_add_time:
-                    minutes = 5 - embed.raid.start_time.minute % 5
-                    new_start_time = min(embed.raid.despawn_time, embed.raid.start_time + datetime.timedelta(minutes=minutes))
-                else:
-                    minutes = embed.raid.start_time.minute % 5
-                    minutes = 5 if minutes == 0 else minutes
-                    new_start_time = max(embed.raid.despawn_time - utils.DESPAWN_TIME, embed.raid.start_time - datetime.timedelta(minutes=minutes))
-                if new_start_time == embed.raid.start_time:
+                self.session.commit()
+                changed = await self.db.run(utils.shift_start_time, embed.raid_id, str(payload.emoji) == emoji_add_time)
+                if not changed:
                     # No point doing a embed update if nothing is changing.
                     return
-                embed.raid.start_time = new_start_time
-                self.session.add(embed.raid)
             else:
+                # Fetch the message rather than using the cache, we need up to date reactions.
+                message = await channel.get_message(payload.message_id)
+                self.messages.add(message)
                 emojis = [emoji_going, emoji_add_person, emoji_remove_person, emoji_add_time, emoji_remove_time]
                 for reaction in message.reactions:
                     if str(reaction) in emojis:
@@ -714,41 +802,84 @@ class Monord(commands.Cog):
                 else:
                     await message.remove_reaction(payload.emoji, member)
         elif embed.embed_type == utils.EMBED_HATCH:
-            pokemons = utils.get_possible_pokemon(self, embed.raid.gym.location, pytz.utc.localize(embed.raid.despawn_time - utils.DESPAWN_TIME - utils.HATCH_TIME), embed.raid.level, embed.raid.ex)
+            pokemons = utils.get_possible_pokemon(self, embed.raid.gym, pytz.utc.localize(embed.raid.despawn_time - utils.DESPAWN_TIME - utils.HATCH_TIME), embed.raid.level, embed.raid.ex)
             num = int(str(payload.emoji)[0]) if str(payload.emoji)[0].isnumeric() else None
             if num is not None:
                 if num > len(pokemons):
                     return
                 pokemon = pokemons[num]
-                await utils.hatch_raid(self, embed.raid, pokemon)
+                # hatch_raid changes the raid through the cogs session.
+                raid = self.session.query(models.Raid).get(embed.raid_id)
+                await utils.hatch_raid(self, raid, pokemon)
                 return
-        await utils.update_raid(self, embed.raid)
+        return embed.raid
+
+    async def handle_reaction(self, payload, event):
+        # Only time the handling, the coalesced update waits out its window.
+        with metrics.reaction_seconds.time(event=event):
+            raid = await self.on_raw_reaction(payload)
+        if raid is not None:
+            await self.updates.request(raid)
 
+    @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
-        await self.on_raw_reaction(payload)
+        await self.handle_reaction(payload, "add")
 
+    @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
-        await self.on_raw_reaction(payload)
+        await self.handle_reaction(payload, "remove")
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        roles.forget_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        roles.forget_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        roles.forget_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        roles.role_created(role)
 
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        roles.role_deleted(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        roles.role_updated(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        roles.emojis_updated(guild)
+
+    @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
+        self.messages.discard(payload.message_id)
+        if payload.message_id not in self.tracked_messages:
+            return
         try:
             deleted_embed = self.session.query(models.Embed).filter_by(channel_id=payload.channel_id, message_id=payload.message_id).one()
         except NoResultFound:
             return
 
-        embeds = self.session.query(models.Embed).filter_by(raid=deleted_embed.raid)
+        embeds = list(self.session.query(models.Embed).filter_by(raid=deleted_embed.raid))
+        # Stop tracking first, so the deletes below are ignored when they come back as events.
+        self.tracked_messages.difference_update(embed.message_id for embed in embeds)
+        tasks = []
         for embed in embeds:
             if embed.channel_id == payload.channel_id and embed.message_id == payload.message_id:
                 continue
-            try:
-                channel = self.bot.get_channel(embed.channel_id)
-                message = await channel.get_message(embed.message_id)
-                await message.delete()
-            except discord.errors.NotFound:
-                pass
-
+            tasks.append(self.messages.delete(embed.channel_id, embed.message_id))
+        await utils.wait_for_tasks(tasks)
 
         self.session.query(models.RaidGoing).filter_by(raid=deleted_embed.raid).delete()
+        await utils.delete_raid_roles(self, deleted_embed.raid)
+        await self.subscriptions.forget(self.db, subscriptions.KIND_RAID, deleted_embed.raid_id)
         self.session.query(models.Embed).filter_by(raid=deleted_embed.raid).delete()
         self.session.query(models.Raid).filter_by(id=deleted_embed.raid_id).delete()
-        timers.raid_reschedule(self)
+        timers.raid_unschedule(self, deleted_embed.raid_id)
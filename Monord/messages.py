@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import discord
+
+MAX_CACHED_MESSAGES = 1000
+
+
+class MessageCache:
+    """
+        Bounded LRU of the messages we've posted, keyed by message id.
+
+        Edits and deletes only need the channel and message ids, so when
+        a message isn't cached they go straight to the API instead of
+        fetching the message first.
+    """
+    def __init__(self, bot, size=MAX_CACHED_MESSAGES):
+        self.bot = bot
+        self.size = size
+        self.messages = OrderedDict()
+        self.fetches = 0
+        self.saved_fetches = 0
+
+    def add(self, message):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        while len(self.messages) > self.size:
+            self.messages.popitem(last=False)
+
+    def discard(self, message_id):
+        self.messages.pop(message_id, None)
+
+    def cached(self, message_id):
+        message = self.messages.get(message_id)
+        if message is not None:
+            self.messages.move_to_end(message_id)
+        return message
+
+    async def get(self, channel, message_id):
+        message = self.cached(message_id)
+        if message is not None:
+            self.saved_fetches += 1
+            return message
+        self.fetches += 1
+        message = await channel.get_message(message_id)
+        self.add(message)
+        return message
+
+    async def edit(self, channel_id, message_id, content=None, embed=None):
+        self.saved_fetches += 1
+        message = self.cached(message_id)
+        if message is not None:
+            await message.edit(content=content, embed=embed)
+            return
+        await self.bot.http.edit_message(
+            message_id,
+            channel_id,
+            content=content,
+            embed=embed.to_dict() if embed is not None else None
+        )
+
+    async def delete(self, channel_id, message_id):
+        """
+            Delete a message, returns False if it was already gone.
+        """
+        self.saved_fetches += 1
+        self.discard(message_id)
+        try:
+            await self.bot.http.delete_message(channel_id, message_id)
+        except discord.errors.NotFound:
+            return False
+        return True
+
+    def info(self):
+        return {
+            "size": len(self.messages),
+            "fetches": self.fetches,
+            "saved_fetches": self.saved_fetches
+        }
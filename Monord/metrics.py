@@ -0,0 +1,182 @@
+from . import config
+from sqlalchemy import event
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, escape(value)) for key, value in labels) + "}"
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Histogram:
+    """
+        Observed from the event loop and from the database pool threads,
+        so every read and write of values holds the lock.
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][i] += 1
+            counts["sum"] += value
+            counts["count"] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, dict(counts, buckets=list(counts["buckets"]))) for labels, counts in self.values.items()]
+        for labels, counts in sorted(values, key=lambda value: value[0]):
+            for bound, count in zip(self.buckets, counts["buckets"]):
+                yield self.name + "_bucket", labels + (("le", bound),), count
+            yield self.name + "_bucket", labels + (("le", "+Inf"),), counts["count"]
+            yield self.name + "_sum", labels, counts["sum"]
+            yield self.name + "_count", labels, counts["count"]
+
+
+class Collector:
+    """
+        Exposes a dict of numbers returned by an existing info() method
+        as a gauge, one sample per key.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, func, label="stat"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def samples(self):
+        for key, value in sorted(self.func().items()):
+            yield self.name, ((self.label, key),), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        # Replace rather than duplicate when the cog is reloaded.
+        self.metrics = [m for m in self.metrics if m.name != metric.name]
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def collect(self, name, help, func, label="stat"):
+        return self.register(Collector(name, help, func, label))
+
+    def render(self):
+        """
+            The Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+command_seconds = registry.histogram("monord_command_seconds", "Time taken to run a command")
+reaction_seconds = registry.histogram("monord_reaction_seconds", "Time taken to handle a raw reaction event")
+scheduler_lag = registry.histogram("monord_scheduler_lag_seconds", "Time between a timer's deadline and it firing")
+discord_requests = registry.histogram("monord_discord_request_seconds", "Discord REST calls per route")
+db_queries = registry.histogram("monord_db_query_seconds", "Database statements by type")
+es_queries = registry.histogram("monord_es_query_seconds", "Elasticsearch calls by type")
+
+
+def instrument_http(http):
+    """
+        Time every Discord REST call made through http.request.
+    """
+    if getattr(http, "instrumented", False):
+        return
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        start = time.monotonic()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, "status", type(e).__name__))
+            raise
+        finally:
+            discord_requests.observe(
+                time.monotonic() - start,
+                route="{} {}".format(route.method, route.path),
+                status=status
+            )
+
+    http.request = timed_request
+    http.instrumented = True
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.monotonic())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        words = statement.split(None, 1)
+        db_queries.observe(time.monotonic() - start, statement=words[0].upper() if words else "")
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+def instrument(cog):
+    instrument_http(cog.bot.http)
+    instrument_engine(cog.db.engine)
+    registry.collect("monord_config_cache", "Guild config cache", config.cache_info)
+    registry.collect("monord_message_cache", "Discord message cache", cog.messages.info)
+    registry.collect("monord_raid_body_cache", "Rendered raid body cache", cog.raid_bodies.info)
+    registry.collect("monord_raid_updates", "Coalesced raid embed updates", cog.updates.info)
+    registry.collect("monord_db_pool", "Database thread pool", cog.db.info)
+    registry.collect("monord_webhook", "MAD webhook events", cog.webhook.info)
@@ -7,10 +7,12 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
     BigInteger,
     String,
-    UniqueConstraint
+    UniqueConstraint,
+    text
 )
 
 
@@ -21,8 +23,9 @@ class Gym(Base):
     __tablename__ = 'gym'
     id = Column(String, primary_key=True)
     title = Column(String)
-    location = Column(Geometry(geometry_type='POINT', srid=4326))
+    location = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False))
     ex = Column(Boolean, default=False)
+    __table_args__ = (Index('idx_gym_location', 'location', postgresql_using='gist'),)
 
 
 class GymAlias(Base):
@@ -32,6 +35,7 @@ class GymAlias(Base):
     gym_id = Column(String, ForeignKey("gym.id"))
     gym = relationship(Gym)
     guild_id = Column(BigInteger)
+    __table_args__ = (Index('ix_gymalias_guild_id_title', 'guild_id', 'title'),)
 
 
 class Pokestop(Base):
@@ -71,6 +75,11 @@ class Raid(Base):
     hatched = Column(Boolean, default=False)
     despawned = Column(Boolean, default=False)
     cancelled = Column(Boolean, default=False)
+    __table_args__ = (
+        Index('ix_raid_despawned_hatched_despawn_time', 'despawned', 'hatched', 'despawn_time'),
+        Index('ix_raid_active_despawn_time', 'despawn_time', postgresql_where=text('despawned = false')),
+        Index('ix_raid_gym_id_despawn_time', 'gym_id', 'despawn_time'),
+    )
 
 
 class Event(Base):
@@ -94,6 +103,11 @@ class Embed(Base):
     raid = relationship(Raid, foreign_keys=[raid_id])
     embed_type = Column(Integer)
     delete_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index('ix_embed_channel_id_message_id', 'channel_id', 'message_id'),
+        Index('ix_embed_raid_id_embed_type', 'raid_id', 'embed_type'),
+        Index('ix_embed_delete_at', 'delete_at', postgresql_where=text('delete_at IS NOT NULL')),
+    )
 
 
 class Going(object):
@@ -127,13 +141,23 @@ class Party(Base):
     __table_args__ = (UniqueConstraint('creator_user_id', 'user_id', name='_creator_user_id_user_id_uc'),)
 
 
+class Subscription(Base):
+    __tablename__ = 'subscription'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger)
+    guild_id = Column(BigInteger)
+    kind = Column(String)
+    target = Column(String, default="")
+    __table_args__ = (UniqueConstraint('user_id', 'guild_id', 'kind', 'target', name='_subscription_uc'),)
+
+
 class GuildConfig(Base):
     __tablename__ = 'guildconfig'
     id = Column(Integer, primary_key=True)
     guild_id = Column(BigInteger)
     channel_id = Column(BigInteger)
     mirror = Column(Boolean, nullable=True, default=None)
-    region = Column(Geometry('POLYGON', srid=4326), nullable=True, default=None)
+    region = Column(Geometry('POLYGON', srid=4326, spatial_index=False), nullable=True, default=None)
     timezone = Column(String, nullable=True, default=None)
     subscriptions = Column(Boolean, nullable=True, default=None)
     delete_after_despawn = Column(Integer, nullable=True, default=None)
@@ -142,6 +166,10 @@ class GuildConfig(Base):
     emoji_remove_person = Column(String, nullable=True, default=None)
     emoji_add_time = Column(String, nullable=True, default=None)
     emoji_remove_time = Column(String, nullable=True, default=None)
+    __table_args__ = (
+        Index('idx_guildconfig_region', 'region', postgresql_using='gist'),
+        Index('ix_guildconfig_guild_id_channel_id', 'guild_id', 'channel_id'),
+    )
 
 
 """class GuildConfig(Base):
@@ -1,4 +1,6 @@
 from shapely.geometry import Polygon
+from shapely.prepared import prep
+from geoalchemy2.shape import to_shape
 
 REGIONS = {
     "americas": Polygon([
@@ -112,3 +114,26 @@ REGIONS = {
         (63.984375, -48.34164617237459),
     ])
 }
+
+PREPARED_REGIONS = {name: prep(region) for name, region in REGIONS.items()}
+
+
+class RegionClassifier:
+    """
+        Works out which REGIONS a gym is in, using prepared geometry.
+        Gyms don't move, so the answer is cached per gym id.
+    """
+    def __init__(self):
+        self.gyms = {}
+
+    def regions_for(self, gym):
+        regions = self.gyms.get(gym.id)
+        if regions is None:
+            location = to_shape(gym.location)
+            regions = self.gyms[gym.id] = frozenset(
+                name for name, region in PREPARED_REGIONS.items() if region.contains(location)
+            )
+        return regions
+
+    def forget(self, gym_id):
+        self.gyms.pop(gym_id, None)
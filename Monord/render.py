@@ -0,0 +1,65 @@
+from . import models
+from collections import OrderedDict, namedtuple
+from sqlalchemy.orm import joinedload
+
+MAX_CACHED_BODIES = 500
+
+GoingSummary = namedtuple("GoingSummary", ["rows", "count", "extra"])
+
+
+def fetch_raid_going(session, raid_id):
+    """
+        Load a raids going rows, along with its gym and pokemon, in a
+        single query
+    """
+    result = session.query(models.Raid, models.RaidGoing).outerjoin(
+        models.RaidGoing,
+        models.RaidGoing.raid_id == models.Raid.id
+    ).options(
+        joinedload(models.Raid.gym),
+        joinedload(models.Raid.pokemon)
+    ).filter(models.Raid.id == raid_id)
+    rows = [going for raid, going in result if going is not None]
+    return GoingSummary(rows, len(rows), sum(going.extra or 0 for going in rows))
+
+
+class RaidBodyCache:
+    """
+        Holds the channel independent part of each raid embed, keyed by
+        raid id and a version counter. Anything that changes a raid bumps
+        its version, so the next render reads the raid again.
+    """
+    def __init__(self, size=MAX_CACHED_BODIES):
+        self.size = size
+        self.bodies = OrderedDict()
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, raid_id):
+        return self.versions.get(raid_id, 0)
+
+    def bump(self, raid_id):
+        self.versions[raid_id] = self.version(raid_id) + 1
+
+    def forget(self, raid_id):
+        self.versions.pop(raid_id, None)
+        self.bodies.pop(raid_id, None)
+
+    def get(self, raid_id):
+        entry = self.bodies.get(raid_id)
+        if entry is None or entry[0] != self.version(raid_id):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bodies.move_to_end(raid_id)
+        return entry[1]
+
+    def put(self, raid_id, body):
+        self.bodies[raid_id] = (self.version(raid_id), body)
+        self.bodies.move_to_end(raid_id)
+        while len(self.bodies) > self.size:
+            self.bodies.popitem(last=False)
+
+    def info(self):
+        return {"size": len(self.bodies), "hits": self.hits, "misses": self.misses}
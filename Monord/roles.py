@@ -0,0 +1,63 @@
+# Per guild lookups of roles by name and emojis by lowercased name. A
+# guild is indexed the first time it's looked up, role and emoji events
+# keep it current after that.
+_roles = {}
+_emojis = {}
+
+
+def index_roles(guild):
+    index = {}
+    for role in guild.roles:
+        # Like a scan of guild.roles, the first role with a name wins.
+        index.setdefault(role.name, role)
+    _roles[guild.id] = index
+    return index
+
+
+def index_emojis(guild):
+    index = {}
+    for emoji in guild.emojis:
+        index.setdefault(emoji.name.lower(), emoji)
+    _emojis[guild.id] = index
+    return index
+
+
+def forget_guild(guild_id):
+    _roles.pop(guild_id, None)
+    _emojis.pop(guild_id, None)
+
+
+def role_created(role):
+    index = _roles.get(role.guild.id)
+    if index is not None:
+        index.setdefault(role.name, role)
+
+
+def role_deleted(role):
+    index = _roles.get(role.guild.id)
+    if index is not None and index.get(role.name) is role:
+        # Another role may share the name, reindex on next lookup.
+        del _roles[role.guild.id]
+
+
+def role_updated(before, after):
+    if before.name != after.name:
+        _roles.pop(after.guild.id, None)
+
+
+def emojis_updated(guild):
+    _emojis.pop(guild.id, None)
+
+
+def find_role(guild, name):
+    index = _roles.get(guild.id)
+    if index is None:
+        index = index_roles(guild)
+    return index.get(name)
+
+
+def find_emoji(guild, name):
+    index = _emojis.get(guild.id)
+    if index is None:
+        index = index_emojis(guild)
+    return index.get(name.lower())
@@ -0,0 +1,121 @@
+from . import models
+from geoalchemy2.shape import to_shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+# GuildConfig settings the router cares about.
+KEYS = ["region", "mirror", "subscriptions"]
+
+
+def same_region(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.equals_exact(b, 0)
+
+
+class Router:
+    """
+        In memory copy of every guild and channel region, used to work out
+        which channels mirror or subscribe to raids on a gym without
+        querying the database.
+
+        A channel receives a gym's raids if it has its own region that
+        contains the gym, or if it has no region and its guild's region
+        contains the gym.
+
+        Changing a region only marks the tree dirty, it is rebuilt on the
+        next lookup so a run of config changes rebuilds it once.
+    """
+    def __init__(self):
+        self.configs = {}
+        self.gyms = {}
+        self.tree = None
+        self.tree_keys = []
+        self.tree_ids = {}
+        self.prepared = {}
+        self.unbounded = {}
+        self.dirty = False
+
+    def load(self, session):
+        self.configs = {}
+        for cfg in session.query(models.GuildConfig):
+            self.set(cfg)
+        self.rebuild()
+
+    def refresh(self, cfg):
+        """
+            Pick up a GuildConfig row that has just been written.
+        """
+        key = (cfg.guild_id, cfg.channel_id)
+        old = self.configs.get(key)
+        self.set(cfg)
+        new = self.configs[key]
+        if old is None or not same_region(old["region"], new["region"]):
+            self.dirty = True
+        # Cached routes may include or miss this channel either way.
+        self.gyms = {}
+
+    def set(self, cfg):
+        self.configs[(cfg.guild_id, cfg.channel_id)] = {
+            "region": to_shape(cfg.region) if cfg.region is not None else None,
+            "mirror": cfg.mirror == True,
+            "subscriptions": cfg.subscriptions == True
+        }
+
+    def rebuild(self):
+        geometries = []
+        self.tree_keys = []
+        self.prepared = {}
+        self.unbounded = {}
+        for key, cfg in self.configs.items():
+            guild_id, channel_id = key
+            if cfg["region"] is not None:
+                geometries.append(cfg["region"])
+                self.tree_keys.append(key)
+                self.prepared[key] = prep(cfg["region"])
+            elif channel_id is not None:
+                self.unbounded.setdefault(guild_id, []).append(key)
+        self.tree = STRtree(geometries) if geometries else None
+        # Shapely < 2 returns geometries from query() rather than indexes.
+        self.tree_ids = {id(geometry): i for i, geometry in enumerate(geometries)}
+        self.gyms = {}
+        self.dirty = False
+
+    def containing(self, point):
+        if self.tree is None:
+            return
+        for hit in self.tree.query(point):
+            i = self.tree_ids[id(hit)] if hasattr(hit, "geom_type") else int(hit)
+            key = self.tree_keys[i]
+            if self.prepared[key].contains(point):
+                yield key
+
+    def route(self, gym):
+        """
+            Returns {"mirror": [channel_id, ...], "subscriptions": [channel_id, ...]}
+            for a gym.
+        """
+        if self.dirty:
+            self.rebuild()
+        routes = self.gyms.get(gym.id)
+        if routes is not None:
+            return routes
+        point = to_shape(gym.location)
+        channels = []
+        for guild_id, channel_id in self.containing(point):
+            if channel_id is None:
+                channels.extend(self.unbounded.get(guild_id, []))
+            else:
+                channels.append((guild_id, channel_id))
+        routes = self.gyms[gym.id] = {"mirror": [], "subscriptions": []}
+        for key in channels:
+            for flag in routes:
+                if self.configs[key][flag]:
+                    routes[flag].append(key[1])
+        return routes
+
+    def mirror_channels(self, gym):
+        return self.route(gym)["mirror"]
+
+    def subscription_channels(self, gym):
+        return self.route(gym)["subscriptions"]
@@ -0,0 +1,82 @@
+from . import es_models
+from . import metrics
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch_dsl import Search
+from os import environ
+import asyncio
+import functools
+import time
+
+# elasticsearch_dsl is synchronous, so every call is run on this pool
+# to keep a slow query from stalling the event loop.
+ES_WORKERS = int(environ.get('ES_WORKERS') or 4)
+ES_TIMEOUT = float(environ.get('ES_TIMEOUT') or 5)
+
+# Whether to fall back to Elasticsearch when the in process matcher (see
+# fuzzy.py) finds nothing.
+ES_FALLBACK = (environ.get('ES_FALLBACK') or "yes").lower() in ["yes", "true", "1"]
+
+executor = ThreadPoolExecutor(max_workers=ES_WORKERS)
+
+# Per query type: count, errors, timeouts, total and max seconds.
+query_stats = {}
+
+
+def record(kind, elapsed, error=None):
+    stats = query_stats.setdefault(kind, {"count": 0, "errors": 0, "timeouts": 0, "total": 0.0, "max": 0.0})
+    stats["count"] += 1
+    stats["total"] += elapsed
+    stats["max"] = max(stats["max"], elapsed)
+    status = "ok"
+    if isinstance(error, asyncio.TimeoutError):
+        stats["timeouts"] += 1
+        status = "timeout"
+    elif error is not None:
+        stats["errors"] += 1
+        status = "error"
+    metrics.es_queries.observe(elapsed, kind=kind, status=status)
+
+
+async def run(kind, func, *args, **kwargs):
+    """
+        Run a blocking Elasticsearch call on the executor, raising
+        asyncio.TimeoutError if it takes longer than ES_TIMEOUT.
+    """
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    error = None
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, functools.partial(func, *args, **kwargs)),
+            ES_TIMEOUT
+        )
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        record(kind, time.monotonic() - start, error)
+
+
+async def get_gym(id):
+    return await run("gym_get", es_models.Gym.get, id=id)
+
+
+async def find_gyms(title, points):
+    s = Search(index="gym").query("match", title={'query': title, 'fuzziness': 2})
+    s = s.filter("geo_polygon", location={"points": points})
+    s.doc_type(es_models.Gym)
+    return await run("gym_search", s.execute)
+
+
+async def find_pokemon(name):
+    s = Search(index="pokemon").query("match", name={'query': name, 'fuzziness': 2})
+    return await run("pokemon_search", s.execute)
+
+
+async def save(kind, doc):
+    return await run("{}_save".format(kind), doc.save)
+
+
+async def delete_gym(id):
+    gym = await get_gym(id)
+    return await run("gym_delete", gym.delete)
@@ -0,0 +1,142 @@
+from . import models
+from sqlalchemy.dialects.postgresql import insert
+
+KIND_POKEMON = "pokemon"
+KIND_GYM = "gym"
+KIND_EX = "ex"
+KIND_RAID = "raid"
+
+# Discord's limit on message content.
+MAX_CONTENT_LENGTH = 2000
+
+
+def mention_users(user_ids, prefix=None, limit=MAX_CONTENT_LENGTH):
+    """
+        prefix followed by a mention of each user, split into as many
+        messages as it takes. The first is at most limit long, the rest
+        are mentions only and at most MAX_CONTENT_LENGTH long.
+    """
+    contents = []
+    content = prefix or ""
+    for user_id in sorted(user_ids):
+        mention = "<@{}>".format(user_id)
+        if content and len(content) + 1 + len(mention) > (limit if not contents else MAX_CONTENT_LENGTH):
+            contents.append(content)
+            content = ""
+        content = content + " " + mention if content else mention
+    if content:
+        contents.append(content)
+    return contents
+
+
+def insert_subscriptions(session, rows):
+    """
+        Insert (guild_id, user_id, kind, target) rows with one statement,
+        skipping any that already exist. Doesn't commit or touch an index,
+        so it can be part of a unit of work on the database pool.
+    """
+    if not rows:
+        return
+    session.execute(insert(models.Subscription.__table__).values([
+        {"guild_id": guild_id, "user_id": user_id, "kind": kind, "target": str(target)}
+        for guild_id, user_id, kind, target in rows
+    ]).on_conflict_do_nothing(constraint='_subscription_uc'))
+
+
+def delete_subscriptions(session, guild_id, user_ids, kind, target=""):
+    session.query(models.Subscription).filter(
+        models.Subscription.guild_id == guild_id,
+        models.Subscription.user_id.in_(user_ids),
+        models.Subscription.kind == kind,
+        models.Subscription.target == str(target)
+    ).delete(synchronize_session=False)
+
+
+def delete_target_subscriptions(session, kind, target):
+    session.query(models.Subscription).filter_by(kind=kind, target=str(target)).delete(synchronize_session=False)
+
+
+class SubscriptionIndex:
+    """
+        In memory copy of the subscription table, inverted so the users
+        to mention for a raid are found without a query.
+
+        Targets are stored as strings, a pokemon id, a gym id, a raid id,
+        or "" for EX. index[(kind, target)][guild_id] is a set of user ids.
+    """
+    def __init__(self):
+        self.index = {}
+
+    def load(self, session):
+        self.index = {}
+        for subscription in session.query(models.Subscription):
+            self.set(subscription.guild_id, subscription.user_id, subscription.kind, subscription.target)
+
+    def set(self, guild_id, user_id, kind, target):
+        self.index.setdefault((kind, str(target)), {}).setdefault(guild_id, set()).add(user_id)
+
+    def discard(self, guild_id, user_id, kind, target):
+        guilds = self.index.get((kind, str(target)), {})
+        guilds.get(guild_id, set()).discard(user_id)
+
+    def subscribers(self, guild_id, kind, target=""):
+        return self.index.get((kind, str(target)), {}).get(guild_id, set())
+
+    def is_subscribed(self, guild_id, user_id, kind, target=""):
+        return user_id in self.subscribers(guild_id, kind, target)
+
+    def for_raid(self, guild_id, raid):
+        """
+            Users to mention about a raid, subscribers to its pokemon,
+            its gym and, if it's on an EX gym, to EX.
+        """
+        users = set(self.subscribers(guild_id, KIND_GYM, raid.gym.id))
+        if raid.pokemon is not None:
+            users |= self.subscribers(guild_id, KIND_POKEMON, raid.pokemon.id)
+        if raid.gym.ex:
+            users |= self.subscribers(guild_id, KIND_EX)
+        return users
+
+    def subscribe(self, session, guild_id, user_id, kind, target=""):
+        if self.is_subscribed(guild_id, user_id, kind, target):
+            return False
+        session.add(models.Subscription(guild_id=guild_id, user_id=user_id, kind=kind, target=str(target)))
+        session.commit()
+        self.set(guild_id, user_id, kind, target)
+        return True
+
+    def subscribe_many(self, session, rows):
+        """
+            Add (guild_id, user_id, kind, target) rows with one statement,
+            returns how many were new.
+        """
+        rows = {(guild_id, user_id, kind, str(target)) for guild_id, user_id, kind, target in rows}
+        rows = [row for row in rows if not self.is_subscribed(*row)]
+        if not rows:
+            return 0
+        insert_subscriptions(session, rows)
+        session.commit()
+        for row in rows:
+            self.set(*row)
+        return len(rows)
+
+    def unsubscribe(self, session, guild_id, user_id, kind, target=""):
+        if not self.is_subscribed(guild_id, user_id, kind, target):
+            return False
+        self.unsubscribe_many(session, guild_id, [user_id], kind, target)
+        return True
+
+    def unsubscribe_many(self, session, guild_id, user_ids, kind, target=""):
+        delete_subscriptions(session, guild_id, user_ids, kind, target)
+        session.commit()
+        for user_id in user_ids:
+            self.discard(guild_id, user_id, kind, target)
+
+    async def forget(self, db, kind, target):
+        """
+            Drop every subscription to a target, in every guild. The rows
+            are deleted as their own unit on the database pool.
+        """
+        if self.index.pop((kind, str(target)), None) is None:
+            return
+        await db.run(delete_target_subscriptions, kind, target)
@@ -2,10 +2,13 @@ import datetime
 import logging
 import sys
 import asyncio
+import heapq
+import pytz
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+from . import metrics
 from . import models
 from . import utils
-import discord
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
 
@@ -16,93 +19,304 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-async def raid_timers(cog):
-    while True:
-        try:
-            # Find the soonest raid that hasn't hatched or despawned.
-            raids = cog.session.query(models.Raid).filter(
-                or_(
-                    models.Raid.despawned == False,
-                    models.Raid.hatched == False
-                )
-            ).order_by('despawn_time')
-
-            # If there are no raids found, stop the loop.
-            if raids.count() == 0:
-                return
-
-            soonest_hatch = raids.filter_by(hatched=False).order_by('despawn_time').first()
-            soonest_despawn = raids.first()
-            if soonest_hatch is not None:
-                raid = soonest_hatch if soonest_hatch.despawn_time - utils.DESPAWN_TIME < soonest_despawn.despawn_time else soonest_despawn
-            else:
-                raid = soonest_despawn
-
-            # If it's hatched use the despawn time.
-            t = raid.despawn_time
-            if raid.hatched == False:
-                t = t - utils.DESPAWN_TIME
-
-            # Wait until hatch / despawn, or until a raid time is changed
-            while cog.raid_time_stale == False and datetime.datetime.utcnow() < t:
-                await asyncio.sleep(1)
-
-            # If a raids time was changed, restart the loop to check for new times
-            if cog.raid_time_stale:
-                cog.raid_time_stale = False
-                continue
+# How many raids are notified about at once when a wave hatches / despawns.
+MAX_CONCURRENT_NOTIFICATIONS = 10
+
+KIND_HATCH = 0
+KIND_DESPAWN = 1
+KIND_EMBED_DELETE = 2
+KIND_NAMES = {KIND_HATCH: "hatch", KIND_DESPAWN: "despawn", KIND_EMBED_DELETE: "embed_delete"}
+
+# How often to look for raid roles left behind by a crash, and how many
+# to delete at once.
+ROLE_SWEEP_INTERVAL = 15 * 60
+ROLE_SWEEP_BATCH = 10
+
+
+def naive_utc(t):
+    """
+        The database hands back naive UTC datetimes, but
+        commands tend to assign timezone aware ones.
+    """
+    if t is not None and t.tzinfo is not None:
+        t = t.astimezone(pytz.utc).replace(tzinfo=None)
+    return t
+
+
+def pending_events(session):
+    raids = session.query(
+        models.Raid.id,
+        models.Raid.despawn_time,
+        models.Raid.hatched,
+        models.Raid.despawned
+    ).filter(
+        or_(
+            models.Raid.despawned == False,
+            models.Raid.hatched == False
+        )
+    ).all()
+    embeds = session.query(models.Embed.id, models.Embed.delete_at).filter(
+        models.Embed.delete_at != None
+    ).all()
+    return raids, embeds
+
+
+def flag_raids(session, raid_ids, values):
+    flag = getattr(models.Raid, list(values)[0])
+    pending = [id for id, in session.query(models.Raid.id).filter(
+        models.Raid.id.in_(raid_ids),
+        flag == False
+    )]
+    if pending:
+        session.query(models.Raid).filter(
+            models.Raid.id.in_(pending)
+        ).update(values, synchronize_session=False)
+    return pending
 
-            if not raid.hatched:
-                raid.hatched = True
-                await utils.notify_hatch(cog, raid)
-            else:
-                raid.despawned = True
-                await utils.mark_raid_despawned(cog, raid)
-            cog.session.add(raid)
-            cog.session.commit()
-        except Exception as e:
-            logger.exception("Error in raid_timers")
-            await asyncio.sleep(5)
 
-async def embed_timers(cog):
+def forget_embeds(session, embed_ids):
+    embeds = session.query(models.Embed.channel_id, models.Embed.message_id).filter(
+        models.Embed.id.in_(embed_ids)
+    ).all()
+    session.query(models.Embed).filter(
+        models.Embed.id.in_(embed_ids)
+    ).delete(synchronize_session=False)
+    return [(embed.channel_id, embed.message_id) for embed in embeds]
+
+
+def orphaned_raid_roles(session, candidates):
+    """
+        Of candidates, (guild_id, role_id, raid_id, name) for roles named
+        like raid roles, returns the (guild_id, role_id) of the ones we
+        made whose raid has despawned.
+
+        Raid roles are no longer created, these are left from before
+        subscriptions were stored. A role is only taken to be ours if its
+        raid exists and it has exactly the name it would have been given.
+    """
+    raid_ids = {raid_id for guild_id, role_id, raid_id, name in candidates}
+    raids = {raid.id: raid for raid in session.query(models.Raid).options(
+        joinedload(models.Raid.gym)
+    ).filter(models.Raid.id.in_(raid_ids))}
+
+    orphaned = []
+    for guild_id, role_id, raid_id, name in candidates:
+        raid = raids.get(raid_id)
+        if raid is not None and raid.despawned and name == utils.raid_role_name(raid):
+            orphaned.append((guild_id, role_id))
+    return orphaned
+
+
+async def sweep_raid_roles(cog):
+    """
+        Delete raid roles left from before subscriptions were stored
+        once their raid has despawned.
+    """
+    candidates = []
+    for guild in cog.bot.guilds:
+        for role in guild.roles:
+            match = utils.RE_RAID_ROLE.match(role.name)
+            if match:
+                candidates.append((guild.id, role.id, int(match.group(1)), role.name))
+    if not candidates:
+        return 0
+    roles = await cog.db.run(orphaned_raid_roles, candidates)
+    for i in range(0, len(roles), ROLE_SWEEP_BATCH):
+        await utils.wait_for_tasks([
+            utils.delete_role(cog, guild_id, role_id) for guild_id, role_id in roles[i:i + ROLE_SWEEP_BATCH]
+        ])
+    return len(roles)
+
+
+async def role_sweeper(cog):
+    await cog.bot.wait_until_ready()
     while True:
         try:
-            # Find the embed that needs deleting.
-            embed = cog.session.query(models.Embed).filter(models.Embed.delete_at != None).order_by('delete_at').first()
-            # If there are no raids found, stop the loop.
-            if embed is None:
-                return
-            # Wait until hatch / despawn, or until a raid time is changed
-            while cog.embed_time_stale == False and datetime.datetime.utcnow() < embed.delete_at:
-                await asyncio.sleep(1)
-
-            # If an embed time was changed, restart the loop to check for new times
-            if cog.embed_time_stale:
-                cog.embed_time_stale = False
+            count = await sweep_raid_roles(cog)
+            if count:
+                logger.info("Deleted {} orphaned raid roles".format(count))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Error sweeping raid roles")
+        await asyncio.sleep(ROLE_SWEEP_INTERVAL)
+
+
+class Scheduler:
+    """
+        Keeps every pending hatch, despawn and embed deletion in a
+        min-heap of (fire_time, kind, id) and sleeps until the soonest one.
+
+        Entries are never removed from the heap directly, instead
+        self.deadlines holds the current fire time for each (kind, id),
+        anything on the heap that doesn't match it is stale and skipped.
+    """
+    def __init__(self, cog):
+        self.cog = cog
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = self.cog.bot.loop.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def load(self):
+        raids, embeds = await self.cog.db.run(pending_events)
+        for raid in raids:
+            self.schedule_raid(raid)
+        for embed in embeds:
+            self.schedule_embed(embed)
+
+    def schedule(self, fire_time, kind, id):
+        fire_time = naive_utc(fire_time)
+        if self.deadlines.get((kind, id)) == fire_time:
+            return
+        self.deadlines[(kind, id)] = fire_time
+        entry = (fire_time, kind, id)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] == entry:
+            # New soonest deadline, wake the loop so it can sleep less.
+            self.wakeup.set()
+
+    def cancel(self, kind, id):
+        self.deadlines.pop((kind, id), None)
+
+    def schedule_raid(self, raid):
+        despawn_time = naive_utc(raid.despawn_time)
+        if raid.hatched:
+            self.cancel(KIND_HATCH, raid.id)
+        else:
+            self.schedule(despawn_time - utils.DESPAWN_TIME, KIND_HATCH, raid.id)
+        if raid.despawned:
+            self.cancel(KIND_DESPAWN, raid.id)
+        else:
+            self.schedule(despawn_time, KIND_DESPAWN, raid.id)
+
+    def unschedule_raid(self, raid_id):
+        self.cancel(KIND_HATCH, raid_id)
+        self.cancel(KIND_DESPAWN, raid_id)
+
+    def schedule_embed(self, embed):
+        if embed.delete_at is None:
+            self.cancel(KIND_EMBED_DELETE, embed.id)
+        else:
+            self.schedule(embed.delete_at, KIND_EMBED_DELETE, embed.id)
+
+    def is_current(self, entry):
+        fire_time, kind, id = entry
+        return self.deadlines.get((kind, id)) == fire_time
+
+    def next_deadline(self):
+        while self.heap and not self.is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self.is_current(entry):
                 continue
+            fire_time, kind, id = entry
+            del self.deadlines[(kind, id)]
+            metrics.scheduler_lag.observe((now - fire_time).total_seconds(), kind=KIND_NAMES[kind])
+            due.append((kind, id))
+        return due
 
+    async def run(self):
+        await self.cog.bot.wait_until_ready()
+        loaded = False
+        while True:
             try:
-                channel = cog.bot.get_channel(embed.channel_id)
-                message = await channel.get_message(embed.message_id)
-                await message.delete()
-            except discord.errors.NotFound as e:
-                logging.exception("Delete failed")
-                pass
-            cog.session.query(models.Embed).filter_by(message_id=embed.message_id).delete()
+                if not loaded:
+                    await self.load()
+                    loaded = True
+                self.wakeup.clear()
+                deadline = self.next_deadline()
+                timeout = None
+                if deadline is not None:
+                    timeout = (deadline - datetime.datetime.utcnow()).total_seconds()
+                if timeout is None or timeout > 0:
+                    try:
+                        # Sleep until the deadline, or until something is rescheduled.
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                await self.fire(self.pop_due(datetime.datetime.utcnow()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Error in scheduler")
+                await asyncio.sleep(5)
 
-        except Exception as e:
-            logger.exception("Error in embed_timers")
-            await asyncio.sleep(5)
-
-def raid_reschedule(cog):
-    if cog.raid_timers_task is None or cog.raid_timers_task.done():
-        cog.raid_timers_task = cog.bot.loop.create_task(raid_timers(cog))
-    else:
-        cog.raid_time_stale = True
-
-def embed_reschedule(cog):
-    if cog.embed_timers_task is None or cog.embed_timers_task.done():
-        cog.embed_timers_task = cog.bot.loop.create_task(embed_timers(cog))
-    else:
-        cog.embed_time_stale = True
-    
+    async def fire(self, due):
+        hatch_ids = [id for kind, id in due if kind == KIND_HATCH]
+        despawn_ids = [id for kind, id in due if kind == KIND_DESPAWN]
+        embed_ids = [id for kind, id in due if kind == KIND_EMBED_DELETE]
+        if hatch_ids:
+            await self.hatch_raids(hatch_ids)
+        if despawn_ids:
+            await self.despawn_raids(despawn_ids)
+        if embed_ids:
+            await self.delete_embeds(embed_ids)
+
+    async def mark_raids(self, raid_ids, **values):
+        """
+            Flag every raid in raid_ids that isn't already flagged with
+            a single UPDATE, then load them back in one query.
+        """
+        # Don't leave the cogs session holding row locks the update would wait on.
+        self.cog.session.commit()
+        pending = await self.cog.db.run(flag_raids, raid_ids, values)
+        if not pending:
+            return []
+        return self.cog.session.query(models.Raid).options(
+            joinedload(models.Raid.gym),
+            joinedload(models.Raid.pokemon)
+        ).filter(models.Raid.id.in_(pending)).populate_existing().all()
+
+    async def notify(self, func, raids):
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_NOTIFICATIONS)
+
+        async def run(raid):
+            async with semaphore:
+                try:
+                    await func(self.cog, raid)
+                except Exception as e:
+                    logger.exception("Error notifying raid {}".format(raid.id))
+
+        await utils.wait_for_tasks([run(raid) for raid in raids])
+
+    async def hatch_raids(self, raid_ids):
+        raids = await self.mark_raids(raid_ids, hatched=True)
+        await self.notify(utils.notify_hatch, raids)
+
+    async def despawn_raids(self, raid_ids):
+        raids = await self.mark_raids(raid_ids, despawned=True)
+        await self.notify(utils.mark_raid_despawned, raids)
+
+    async def delete_embeds(self, embed_ids):
+        self.cog.session.commit()
+        # Forget the embeds before deleting the messages, otherwise on_raw_message_delete
+        # treats it as a user deleting the raid.
+        messages = await self.cog.db.run(forget_embeds, embed_ids)
+        self.cog.tracked_messages.difference_update(message_id for channel_id, message_id in messages)
+        await utils.wait_for_tasks([
+            self.cog.messages.delete(channel_id, message_id) for channel_id, message_id in messages
+        ])
+
+def raid_reschedule(cog, raid):
+    cog.scheduler.schedule_raid(raid)
+
+def raid_unschedule(cog, raid_id):
+    cog.scheduler.unschedule_raid(raid_id)
+
+def embed_reschedule(cog, embed):
+    cog.scheduler.schedule_embed(embed)
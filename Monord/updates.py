@@ -0,0 +1,54 @@
+import asyncio
+from os import environ
+from . import utils
+
+# Seconds to wait for more changes to a raid before re-rendering its embeds.
+UPDATE_WINDOW = float(environ.get('UPDATE_WINDOW') or 1)
+
+
+class UpdateCoalescer:
+    """
+        Collapses bursts of update requests for the same raid into a
+        single utils.update_raid call, so ten people pressing going in
+        the same second cause one edit per channel instead of ten.
+    """
+    def __init__(self, cog, window=UPDATE_WINDOW):
+        self.cog = cog
+        self.window = window
+        self.pending = {}
+        self.requested = 0
+        self.renders = 0
+        self.saved_edits = 0
+
+    async def request(self, raid):
+        """
+            Queue a re-render of raid, returns once a render that
+            includes the change has been sent.
+        """
+        self.requested += 1
+        pending = self.pending.get(raid.id)
+        if pending is None:
+            pending = self.pending[raid.id] = {"requests": 0}
+            pending["task"] = self.cog.bot.loop.create_task(self.flush(raid))
+        pending["requests"] += 1
+        await asyncio.shield(pending["task"])
+
+    async def flush(self, raid):
+        await asyncio.sleep(self.window)
+        # Anything requested from here on needs another render.
+        pending = self.pending.pop(raid.id)
+        self.renders += 1
+        edits = await utils.update_raid(self.cog, raid)
+        self.saved_edits += edits * (pending["requests"] - 1)
+
+    def stop(self):
+        for pending in self.pending.values():
+            pending["task"].cancel()
+
+    def info(self):
+        return {
+            "requested": self.requested,
+            "renders": self.renders,
+            "saved_renders": self.requested - self.renders - sum(p["requests"] for p in self.pending.values()),
+            "saved_edits": self.saved_edits
+        }
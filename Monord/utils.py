@@ -1,22 +1,31 @@
 import discord
 from . import models
 from . import es_models
+from . import search
 from . import config
 from . import timers
 from . import stats
-from .regions import REGIONS
+from . import dispatch
+from . import render
+from . import availability
+from . import roles
+from . import subscriptions
+from .regions import PREPARED_REGIONS
 import pytz
 import asyncio
+import itertools
 import datetime
 from shapely.geometry import Point
 from geoalchemy2.shape import from_shape, to_shape
-from sqlalchemy import func, and_, or_
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import func
 import json
 import gettext
 import re
 import random
 RE_EMOJI = re.compile("\<\:(.+):(\d+)>")
+RE_RAID_ROLE = re.compile(r"^Raid .+ \(#(\d+)\)$")
 
 _ = gettext.gettext
 
@@ -25,6 +34,9 @@ DESPAWN_TIME = datetime.timedelta(minutes=45)
 
 EMBED_RAID = 1
 EMBED_HATCH = 2
+# Follow up messages mentioning the subscribers that didn't fit in a raid
+# or hatch message, never reacted to.
+EMBED_MENTION = 3
 
 def prepare_gym_embed(gym):
     es_gym, sql_gym = gym
@@ -38,7 +50,7 @@ def prepare_gym_embed(gym):
     embed.set_footer(text="Gym ID {}.".format(es_gym.meta["id"]))
     return embed
 
-def add_gym(session, id, latitude, longitude, ex, title):
+async def add_gym(session, id, latitude, longitude, ex, title):
     gym = models.Gym(
         id=id,
         title=title,
@@ -53,7 +65,7 @@ def add_gym(session, id, latitude, longitude, ex, title):
         title=title,
         location={"lat": latitude, "lon": longitude},
     )
-    gymdoc.save()
+    await search.save("gym", gymdoc)
     return gym, gymdoc
 
 def get_raid_at_time(session, gym, time):
@@ -87,9 +99,7 @@ def get_display_name(channel, member, extra=0):
     return result
 
 def get_emoji_by_name(guild, name):
-    for emoji in guild.emojis:
-        if emoji.name.lower() == name.lower():
-            return emoji
+    return roles.find_emoji(guild, name)
 
 def format_time(cog, channel, t):
     tz = pytz.timezone(config.get(cog.session, "timezone", channel))
@@ -110,31 +120,44 @@ async def wait_for_tasks(tasks):
     for task in done:
         task.result()
 
-def format_raid(cog, channel, raid):
+def raid_changed(cog, raid):
+    """
+        Invalidate the cached embed body of a raid
+    """
+    cog.raid_bodies.bump(raid.id)
+
+def render_raid_body(cog, raid, going=None):
+    """
+        Render the parts of a raid embed that are the same in every
+        channel, the result is cached until raid_changed is called.
+        going is the raids GoingSummary, if it has already been loaded.
+    """
+    body = cog.raid_bodies.get(raid.id)
+    if body is not None:
+        return body
+
+    if going is None:
+        going = render.fetch_raid_going(cog.session, raid.id)
+
     title = raid.gym.title
     title = "{} (#{})".format(title, raid.id)
     if raid.ex:
         title = "EX: "+title
 
-    going = cog.session.query(models.RaidGoing).filter_by(raid=raid)
-
-    users = []
-    num_extra = 0
-    if going.count():
-        for g in going:
-            guild = cog.bot.get_guild(g.guild_id)
-            if guild is None:
-                continue
-            member = guild.get_member(g.user_id)
-            if member is None:
-                continue
-            num_extra += g.extra
-            display_name = get_display_name(channel, member, g.extra)
-            users.append(display_name)
-        users.sort()
+    guilds = {}
+    members = []
+    for g in going.rows:
+        if g.guild_id not in guilds:
+            guilds[g.guild_id] = cog.bot.get_guild(g.guild_id)
+        if guilds[g.guild_id] is None:
+            continue
+        member = guilds[g.guild_id].get_member(g.user_id)
+        if member is None:
+            continue
+        members.append((member, g.extra))
 
     if raid.pokemon is None:
-        description = _("**Level**: {}").format(raid.level) + "\n"
+        header = _("**Level**: {}").format(raid.level) + "\n"
         image = "https://www.trainerdex.co.uk/egg/{}.png".format(raid.level)
     else:
         if raid.pokemon.shiny and random.randrange(1,26) == 1 and raid.pokemon.id not in (114,132):
@@ -145,67 +168,77 @@ def format_raid(cog, channel, raid):
         if raid.pokemon.shiny:
             name += ":sparkles:"
         if raid.pokemon.raid_level:
-            description = _("**Pokemon**: {} (Level {})").format(name, raid.pokemon.raid_level) + "\n"
+            header = _("**Pokemon**: {} (Level {})").format(name, raid.pokemon.raid_level) + "\n"
         else:
-            description = _("**Pokemon**: {}").format(name, raid.pokemon.raid_level) + "\n"
-
-    description += _("**Start Time**: {}").format(format_time(cog, channel, raid.start_time)) + "\n"
-    if datetime.datetime.utcnow() < raid.despawn_time - DESPAWN_TIME:
-        description += _("**Hatches at**: {}").format(format_time(cog, channel, raid.despawn_time - DESPAWN_TIME)) + "\n"
-    description += _("**Despawns at**: {}").format(format_time(cog, channel, raid.despawn_time)) + "\n"
+            header = _("**Pokemon**: {}").format(name, raid.pokemon.raid_level) + "\n"
 
+    details = ""
     if raid.pokemon is not None:
         if None not in [raid.pokemon.perfect_cp, raid.pokemon.perfect_cp_boosted]:
-            description += _("**Perfect CP**: {} / {}").format(raid.pokemon.perfect_cp, raid.pokemon.perfect_cp_boosted) + "\n"
+            details += _("**Perfect CP**: {} / {}").format(raid.pokemon.perfect_cp, raid.pokemon.perfect_cp_boosted) + "\n"
         if raid.pokemon.types is not None:
             counters_int = stats.get_counter_types(raid.pokemon.types)
             counters = stats.from_int(counters_int)
-            description += _("**Weak against**: {}").format(", ".join([_(counter) for counter in counters])) + "\n"
+            details += _("**Weak against**: {}").format(", ".join([_(counter) for counter in counters])) + "\n"
+
+    location = to_shape(raid.gym.location)
+    body = {
+        "title": title,
+        "url": "https://www.google.com/maps/dir/Current+Location/{},{}".format(location.y, location.x),
+        "image": image,
+        "header": header,
+        "details": details,
+        "members": members,
+        "count": going.count + going.extra,
+        "ex_eligible": not raid.ex and raid.gym.ex
+    }
+    cog.raid_bodies.put(raid.id, body)
+    return body
+
+def raid_mentions(cog, channel, raid, content_limit=subscriptions.MAX_CONTENT_LENGTH):
+    """
+        The messages mentioning everyone subscribed to a raid in channel,
+        the first is sent with the raid and the rest after it.
+    """
+    if raid.ex or not config.get(cog.session, "subscriptions", channel):
+        return []
+    prefix = None
+    if not raid.pokemon:
+        egg_role = find_role(channel.guild, _("Level {} egg").format(raid.level))
+        if egg_role:
+            prefix = egg_role.mention
+    return subscriptions.mention_users(cog.subscriptions.for_raid(channel.guild.id, raid), prefix, content_limit)
+
+def format_raid(cog, channel, raid, mentions=None):
+    body = render_raid_body(cog, raid)
+    users = sorted([get_display_name(channel, member, extra) for member, extra in body["members"]])
+
+    description = body["header"]
+    description += _("**Start Time**: {}").format(format_time(cog, channel, raid.start_time)) + "\n"
+    if datetime.datetime.utcnow() < raid.despawn_time - DESPAWN_TIME:
+        description += _("**Hatches at**: {}").format(format_time(cog, channel, raid.despawn_time - DESPAWN_TIME)) + "\n"
+    description += _("**Despawns at**: {}").format(format_time(cog, channel, raid.despawn_time)) + "\n"
+    description += body["details"]
 
     if datetime.datetime.utcnow() < raid.despawn_time - DESPAWN_TIME:
-        description += _("**Interested ({})**").format(going.count()+num_extra) + "\n"
+        description += _("**Interested ({})**").format(body["count"]) + "\n"
     else:
-        description += _("**Going ({})**").format(going.count()+num_extra) + "\n"
+        description += _("**Going ({})**").format(body["count"]) + "\n"
 
     description += "\n".join(users) + "\n"
     emoji_going = config.get(cog.session, "emoji_going", channel)
-    if not raid.ex and raid.gym.ex:
+    if body["ex_eligible"]:
         description += _("This raid has the possibility of giving you an EX raid pass") + "\n"
     description += _("Press the {} below if you want to do this raid").format(emoji_going)
 
-    location = to_shape(raid.gym.location)
-    kwargs = {
-        "title": title,
-        "url": "https://www.google.com/maps/dir/Current+Location/{},{}".format(location.y, location.x),
-        "description": description
-    }
+    embed=discord.Embed(title=body["title"], url=body["url"], description=description)
 
-    embed=discord.Embed(**kwargs)
-
-    embed.set_thumbnail(url=image)
+    embed.set_thumbnail(url=body["image"])
     embed.set_footer(text=_("Raid ID {}. Ignore emoji counts, they are inaccurate.").format(raid.id))
 
-    subscriptions = config.get(cog.session, "subscriptions", channel)
-    if subscriptions and not raid.ex:
-        roles = []
-        if raid.pokemon:
-            pokemon_role = find_role(channel.guild, raid.pokemon.name)
-            if pokemon_role:
-                roles.append(pokemon_role)
-        else:
-            egg_role = find_role(channel.guild, _("Level {} egg").format(raid.level))
-            if egg_role:
-                roles.append(egg_role)
-        gym_role = find_role(channel.guild, raid.gym.title)
-        if gym_role:
-            roles.append(gym_role)
-        if raid.gym.ex:
-            ex_role = find_role(channel.guild, _("EX Eligible"))
-            if ex_role:
-                roles.append(ex_role)
-        content = " ".join([role.mention for role in roles])
-    else:
-        content = None
+    if mentions is None:
+        mentions = raid_mentions(cog, channel, raid)
+    content = mentions[0] if mentions else None
     return {"embed": embed, "content": content}
 
 def emoji_from_string(guild, emoji):
@@ -229,56 +262,144 @@ async def add_raid_reactions(session, message):
     except discord.errors.NotFound:
         pass
 
-async def send_raid(cog, channel, raid, extra_content=None):
-    embeds = list(cog.session.query(models.Embed).filter_by(channel_id=channel.id, raid=raid, embed_type=EMBED_RAID))
+async def send_raid(cog, channel, raid, extra_content=None, extra_mentions=[]):
+    embeds = list(cog.session.query(models.Embed).filter(
+        models.Embed.channel_id == channel.id,
+        models.Embed.raid == raid,
+        models.Embed.embed_type.in_([EMBED_RAID, EMBED_MENTION])
+    ))
     cog.session.query(models.Embed).filter_by(channel_id=channel.id, raid=raid).delete()
-    for embed in embeds:
-        try:
-            message = await channel.get_message(embed.message_id)
-            await message.delete()
-        except discord.errors.NotFound:
-            pass
+    cog.tracked_messages.difference_update(embed.message_id for embed in embeds)
+    await wait_for_tasks([cog.messages.delete(channel.id, embed.message_id) for embed in embeds])
 
-    formatted_raid = format_raid(cog, channel, raid)
+    content_limit = subscriptions.MAX_CONTENT_LENGTH
+    if extra_content != None:
+        content_limit -= len(extra_content) + 1
+    mentions = raid_mentions(cog, channel, raid, content_limit)
+    formatted_raid = format_raid(cog, channel, raid, mentions)
     if extra_content != None:
         if formatted_raid["content"] is not None:
             formatted_raid["content"] = extra_content + "\n" + formatted_raid["content"]
         else:
             formatted_raid["content"] = extra_content
     message = await channel.send(**formatted_raid)
+    cog.messages.add(message)
+    cog.tracked_messages.add(message.id)
     embed = models.Embed(channel_id=channel.id, message_id=message.id, raid_id=raid.id, embed_type=EMBED_RAID)
     delete_after_despawn = config.get(cog.session, "delete_after_despawn", channel)
     if delete_after_despawn is not None:
         embed.delete_at = raid.despawn_time + datetime.timedelta(minutes=delete_after_despawn)
     cog.session.add(embed)
     cog.session.commit()
-    timers.embed_reschedule(cog)
-    await add_raid_reactions(cog.session, message)
+    timers.embed_reschedule(cog, embed)
+    # Reactions have their own rate limit bucket, don't make the next send wait for them.
+    cog.dispatcher.background((dispatch.BUCKET_REACTIONS, channel.id), add_raid_reactions(cog.session, message))
+    await send_mentions(cog, channel, raid, list(extra_mentions) + mentions[1:])
+
+async def send_mentions(cog, channel, raid, contents):
+    """
+        Send mention only messages, deleted along with the raid's other
+        messages.
+    """
+    if not contents:
+        return
+    delete_after_despawn = config.get(cog.session, "delete_after_despawn", channel)
+    embeds = []
+    for content in contents:
+        message = await channel.send(content)
+        cog.messages.add(message)
+        embed = models.Embed(channel_id=channel.id, message_id=message.id, raid_id=raid.id, embed_type=EMBED_MENTION)
+        if delete_after_despawn is not None:
+            embed.delete_at = raid.despawn_time + datetime.timedelta(minutes=delete_after_despawn)
+        embeds.append(embed)
+    cog.session.add_all(embeds)
+    cog.session.commit()
+    for embed in embeds:
+        timers.embed_reschedule(cog, embed)
+
+def find_embed(session, channel_id, message_id):
+    """
+        The Embed for one of our messages, with its raid, gym and pokemon
+        loaded, or None.
+    """
+    return session.query(models.Embed).options(
+        joinedload(models.Embed.raid).joinedload(models.Raid.gym),
+        joinedload(models.Embed.raid).joinedload(models.Raid.pokemon)
+    ).filter_by(channel_id=channel_id, message_id=message_id).first()
+
+def shift_start_time(session, raid_id, later):
+    """
+        Move a raids start time to the next (or previous) five minutes,
+        within the time it's up. Returns whether it changed.
+    """
+    raid = session.query(models.Raid).get(raid_id)
+    if later:
+        minutes = 5 - raid.start_time.minute % 5
+        new_start_time = min(raid.despawn_time, raid.start_time + datetime.timedelta(minutes=minutes))
+    else:
+        minutes = raid.start_time.minute % 5
+        minutes = 5 if minutes == 0 else minutes
+        new_start_time = max(raid.despawn_time - DESPAWN_TIME, raid.start_time - datetime.timedelta(minutes=minutes))
+    if new_start_time == raid.start_time:
+        return False
+    raid.start_time = new_start_time
+    return True
+
+def forget_embed(session, message_id):
+    session.query(models.Embed).filter_by(message_id=message_id).delete()
+
+async def edit_raid_message(cog, embed, formatted_raid):
+    try:
+        await cog.messages.edit(embed.channel_id, embed.message_id, **formatted_raid)
+    except discord.errors.NotFound:
+        cog.tracked_messages.discard(embed.message_id)
+        await cog.db.run(forget_embed, embed.message_id)
+
+def load_raid_update(session, raid_id):
+    """
+        Everything update_raid reads: the raid with its gym and pokemon,
+        its going rows and its raid embeds.
+    """
+    going = render.fetch_raid_going(session, raid_id)
+    # Loaded by fetch_raid_going, this doesn't query.
+    raid = session.query(models.Raid).get(raid_id)
+    embeds = session.query(models.Embed).filter_by(raid_id=raid_id, embed_type=EMBED_RAID).all()
+    return raid, going, embeds
+
+def set_delete_at(session, delete_ats):
+    for embed_id, delete_at in delete_ats:
+        session.query(models.Embed).filter_by(id=embed_id).update({"delete_at": delete_at}, synchronize_session=False)
 
 async def update_raid(cog, raid, exclude_channels=[]):
+    raid_id = raid.id
+    raid_changed(cog, raid)
     cog.session.commit()
-    embeds = list(cog.session.query(models.Embed).filter_by(raid=raid, embed_type=EMBED_RAID))
+    # Rendered from a copy loaded on the pool, the cogs raid may be stale.
+    raid, going, embeds = await cog.db.run(load_raid_update, raid_id)
+    if raid is None:
+        return 0
+    render_raid_body(cog, raid, going)
     tasks = []
+    rescheduled = []
     for embed in embeds:
         channel = cog.bot.get_channel(embed.channel_id)
-        if channel in exclude_channels:
+        if channel is None or channel in exclude_channels:
             continue
-        try:
-            message = await channel.get_message(embed.message_id)
-        except discord.errors.NotFound:
-            cog.session.query(models.Embed).filter_by(message_id=embed.message_id).delete()
-            continue
-        tasks.append(message.edit(**format_raid(cog, channel, raid)))
-    delete_after_despawn = config.get(cog.session, "delete_after_despawn", channel)
-    if delete_after_despawn is not None:
-        delete_at = raid.despawn_time + datetime.timedelta(minutes=delete_after_despawn)
-        if embed.delete_at != delete_at:
-            embed.delete_at = delete_at
-            cog.session.add(embed)
-            cog.session.commit()
-    await wait_for_tasks(tasks)
-
-async def create_raid(cog, time, pokemon, gym, ex, triggered_by=None, triggered_channel=None):
+        tasks.append((channel, edit_raid_message(cog, embed, format_raid(cog, channel, raid))))
+        delete_after_despawn = config.get(cog.session, "delete_after_despawn", channel)
+        if delete_after_despawn is not None:
+            delete_at = raid.despawn_time + datetime.timedelta(minutes=delete_after_despawn)
+            if embed.delete_at != delete_at:
+                embed.delete_at = delete_at
+                rescheduled.append(embed)
+    if rescheduled:
+        await cog.db.run(set_delete_at, [(embed.id, embed.delete_at) for embed in rescheduled])
+        for embed in rescheduled:
+            timers.embed_reschedule(cog, embed)
+    await cog.dispatcher.fan_out(tasks)
+    return len(tasks)
+
+def build_raid(cog, time, pokemon, gym, ex):
     # Calculate a sensible start time.
     start_time = time - DESPAWN_TIME # Set proposed start time to hatch.
     if start_time < pytz.utc.localize(datetime.datetime.utcnow()): # If the time is in the past, fix it.
@@ -287,7 +408,7 @@ async def create_raid(cog, time, pokemon, gym, ex, triggered_by=None, triggered_
         start_time = start_time - datetime.timedelta(minutes=2)
 
     if isinstance(pokemon, int):
-        pokemons = get_possible_pokemon(cog, gym.location, time - DESPAWN_TIME - HATCH_TIME, pokemon, ex)
+        pokemons = get_possible_pokemon(cog, gym, time - DESPAWN_TIME - HATCH_TIME, pokemon, ex)
         if len(pokemons) == 1:
             pokemon = pokemons[0]
 
@@ -301,93 +422,58 @@ async def create_raid(cog, time, pokemon, gym, ex, triggered_by=None, triggered_
         level=pokemon if isinstance(pokemon, int) else pokemon.raid_level,
         hatched=False if isinstance(pokemon, int) else True
     )
+    return raid
+
+async def create_raid(cog, time, pokemon, gym, ex, triggered_by=None, triggered_channel=None):
+    raid = build_raid(cog, time, pokemon, gym, ex)
     cog.session.add(raid)
     cog.session.commit() # Required as we need raids ID in the embed
+    await broadcast_raid(cog, raid, triggered_channel)
 
-    timers.raid_reschedule(cog)
+async def broadcast_raid(cog, raid, triggered_channel=None):
+    """
+        Schedule a committed raid and send it to the channel it was
+        reported in and every channel mirroring its gym.
+    """
+    timers.raid_reschedule(cog, raid)
+    gym = raid.gym
 
     tasks = []
     if triggered_channel is not None:
-        tasks.append(send_raid(cog, triggered_channel, raid))
+        tasks.append((triggered_channel, send_raid(cog, triggered_channel, raid)))
 
-    guilds = cog.session.query(models.GuildConfig).filter(
-        models.GuildConfig.channel_id == None,
-        models.GuildConfig.region != None,
-        func.ST_Contains(models.GuildConfig.region, gym.location)
-    )
-    channels = cog.session.query(models.GuildConfig).filter(
-        or_(
-            and_(
-                models.GuildConfig.guild_id.in_([guild.guild_id for guild in guilds]),
-                models.GuildConfig.mirror == True,
-                models.GuildConfig.region == None
-            ),
-            and_(
-                models.GuildConfig.channel_id != None,
-                models.GuildConfig.mirror == True,
-                func.ST_Contains(models.GuildConfig.region, gym.location)
-            )
-        )
-    )
-
-    for cfg in channels:
-        channel = cog.bot.get_channel(cfg.channel_id)
+    for channel_id in cog.router.mirror_channels(gym):
+        channel = cog.bot.get_channel(channel_id)
         if channel == triggered_channel:
             continue # Don't broadcast twice in the same channel
         if channel == None:
             continue # Channel is missing, don't broadcast to it.
-        tasks.append(send_raid(cog, channel, raid))
+        tasks.append((channel, send_raid(cog, channel, raid)))
 
-    await wait_for_tasks(tasks)
+    await cog.dispatcher.fan_out(tasks)
 
 def check_availability(pokemon, location, time, level):
-    location = to_shape(location)
-    availability_rules = json.loads(pokemon.availability_rules)
     if level != pokemon.raid_level:
         return False
-    if availability_rules is None:
-        if pokemon.raid_level:
-            return True
-        return False
-    for ruleset in availability_rules:
-        available = True
-        for rule in ruleset:
-            if rule["type"] == "time":
-                start_time = pytz.utc.localize(datetime.datetime.strptime(rule["start"], "%Y-%m-%dT%H:%M:%SZ"))
-                end_time = pytz.utc.localize(datetime.datetime.strptime(rule["end"], "%Y-%m-%dT%H:%M:%SZ"))
-                if not start_time <= time <= end_time:
-                    available = False
-                    break
-            elif rule["type"] == "region":
-                if "region" not in rule or \
-                        rule["region"] not in REGIONS or \
-                        not REGIONS[rule["region"].lower()].contains(location):
-                    available = False
-                    break                    
-        if available:
-            return True
-    return False
-
-def get_possible_pokemon(cog, location, time, level, ex):
-    pokemons = cog.session.query(models.Pokemon).filter_by(
-        raid_level=level,
-        ex=ex
-    ).order_by("name")
-    filtered_pokemons = []
-    for pokemon in pokemons:
-        if check_availability(pokemon, location, time, level):
-            filtered_pokemons.append(pokemon)
-    return filtered_pokemons
+    location = to_shape(location)
+    rulesets = availability.compile_rules(pokemon.availability_rules)
+    return availability.is_available(
+        rulesets,
+        pokemon.raid_level,
+        availability.to_epoch(time),
+        lambda region: PREPARED_REGIONS[region].contains(location)
+    )
+
+def get_possible_pokemon(cog, gym, time, level, ex):
+    regions = cog.regions.regions_for(gym)
+    return cog.availability.possible(cog.session, regions, time, level, ex)
 
 async def send_hatch(cog, channel, raid):
-    role = find_role(channel.guild, _("Raid {} (#{})").format(raid.gym.title, raid.id))
-    if role:
-        content = role.mention
-    else:
-        content = None
+    mentions = subscriptions.mention_users(cog.subscriptions.subscribers(channel.guild.id, subscriptions.KIND_RAID, raid.id))
+    content = mentions[0] if mentions else None
 
     description = _("This raid has hatched, can you see what it is?") + "\n"
-    pokemons = get_possible_pokemon(cog, raid.gym.location, pytz.utc.localize(raid.despawn_time - DESPAWN_TIME - HATCH_TIME), raid.level, raid.ex)
+    pokemons = get_possible_pokemon(cog, raid.gym, pytz.utc.localize(raid.despawn_time - DESPAWN_TIME - HATCH_TIME), raid.level, raid.ex)
     for i, pokemon in enumerate(pokemons):
         if i > 9:
             break
@@ -401,6 +487,8 @@ async def send_hatch(cog, channel, raid):
     embed.set_footer(text="Raid ID {}.".format(raid.id))
 
     message = await channel.send(content, embed=embed)
+    cog.messages.add(message)
+    cog.tracked_messages.add(message.id)
 
     embed = models.Embed(channel_id=channel.id, message_id=message.id, raid=raid, embed_type=EMBED_HATCH)
     delete_after_despawn = config.get(cog.session, "delete_after_despawn", channel)
@@ -408,37 +496,24 @@ async def send_hatch(cog, channel, raid):
         embed.delete_at = raid.despawn_time + datetime.timedelta(minutes=delete_after_despawn)
     cog.session.add(embed)
     cog.session.commit()
+    timers.embed_reschedule(cog, embed)
 
+    await send_mentions(cog, channel, raid, mentions[1:])
     for i in range(0, min(len(pokemons), 10)):
         await message.add_reaction(str(i)+"\u20E3")
 
 def get_subscription_channels(cog, raid):
-    guilds = cog.session.query(models.GuildConfig).filter(
-        models.GuildConfig.channel_id == None,
-        models.GuildConfig.region != None,
-        func.ST_Contains(models.GuildConfig.region, raid.gym.location)
-    )
-    channels = cog.session.query(models.GuildConfig).filter(
-        or_(
-            and_(
-                models.GuildConfig.guild_id.in_([guild.guild_id for guild in guilds]),
-                models.GuildConfig.subscriptions == True,
-                models.GuildConfig.region == None
-            ),
-            and_(
-                models.GuildConfig.channel_id != None,
-                models.GuildConfig.subscriptions == True,
-                func.ST_Contains(models.GuildConfig.region, raid.gym.location)
-            )
-        )
-    )
+    channels = []
+    for channel_id in cog.router.subscription_channels(raid.gym):
+        channel = cog.bot.get_channel(channel_id)
+        if channel is not None:
+            channels.append(channel)
     return channels
 
 async def notify_hatch(cog, raid):
     channels = get_subscription_channels(cog, raid)
     tasks = []
-    for cfg in channels:
-        channel = cog.bot.get_channel(cfg.channel_id)
+    for channel in channels:
         tasks.append(send_hatch(cog, channel, raid))
 
     await wait_for_tasks(tasks)
@@ -451,147 +526,190 @@ async def hatch_raid(cog, raid, pokemon):
     tasks = []
 
     await update_raid(cog, raid, exclude_channels=channels)
-    for cfg in channels:
-        channel = cog.bot.get_channel(cfg.channel_id)
-        role = find_role(channel.guild, _("Raid {} (#{})").format(raid.gym.title, raid.id))
-        if role:
-            title = role.mention
-        else:
-            title = raid.gym.title
-        message = _("{} is a {}").format(title, pokemon.name)
-        tasks.append(send_raid(cog, channel, raid, message))
+    for channel in channels:
+        going = cog.subscriptions.subscribers(channel.guild.id, subscriptions.KIND_RAID, raid.id)
+        # Leave the other half for the pokemon's subscribers.
+        mentions = subscriptions.mention_users(going, _("{} is a {}").format(raid.gym.title, pokemon.name), subscriptions.MAX_CONTENT_LENGTH // 2)
+        tasks.append(send_raid(cog, channel, raid, mentions[0], mentions[1:]))
 
     embeds = list(cog.session.query(models.Embed).filter_by(raid=raid, embed_type=EMBED_HATCH))
     cog.session.query(models.Embed).filter_by(raid=raid, embed_type=EMBED_HATCH).delete()
+    cog.tracked_messages.difference_update(embed.message_id for embed in embeds)
     for embed in embeds:
-        message = await channel.get_message(embed.message_id)
-        tasks.append(message.delete())
+        tasks.append(cog.messages.delete(embed.channel_id, embed.message_id))
 
     await wait_for_tasks(tasks)
 
+def going_user_ids(session, raid_id):
+    return {user_id for user_id, in session.query(models.RaidGoing.user_id).filter_by(raid_id=raid_id)}
+
+def with_party(session, triggered_by_id, members_list):
+    """
+        members_list, (guild_id, user_id, extra) tuples, along with the
+        party of triggered_by_id if they are adding themselves.
+    """
+    if triggered_by_id not in [user_id for guild_id, user_id, extra in members_list]:
+        return members_list
+    party_members = session.query(models.Party).filter_by(creator_user_id=triggered_by_id)
+    return members_list + [(party_member.guild_id, party_member.user_id, party_member.extra) for party_member in party_members]
+
+def insert_going(session, raid_id, members_list, going=None):
+    """
+        Add members_list as going to a raid and subscribe them to it,
+        skipping anyone already going. Returns the (guild_id, user_id)
+        of everyone added.
+    """
+    if going is None:
+        going = going_user_ids(session, raid_id)
+    # The first mention of a member wins.
+    rows = {}
+    for guild_id, user_id, extra in members_list:
+        if user_id not in going and user_id not in rows:
+            rows[user_id] = (guild_id, extra)
+    if not rows:
+        return []
+    session.execute(insert(models.RaidGoing.__table__).values([
+        {"raid_id": raid_id, "user_id": user_id, "guild_id": guild_id, "extra": extra}
+        for user_id, (guild_id, extra) in sorted(rows.items())
+    ]).on_conflict_do_nothing(constraint='_raid_id_user_uc'))
+    subscriptions.insert_subscriptions(session, [
+        (guild_id, user_id, subscriptions.KIND_RAID, raid_id) for user_id, (guild_id, extra) in rows.items()
+    ])
+    return [(guild_id, user_id) for user_id, (guild_id, extra) in rows.items()]
+
+def delete_going(session, raid_id, members_list):
+    """
+        Remove members_list from going to a raid and unsubscribe them
+        from it. Returns the (guild_id, user_id) of everyone removed.
+    """
+    if not members_list:
+        return []
+    members = sorted({(guild_id, user_id) for guild_id, user_id, extra in members_list})
+    session.query(models.RaidGoing).filter(
+        models.RaidGoing.raid_id == raid_id,
+        models.RaidGoing.user_id.in_([user_id for guild_id, user_id in members])
+    ).delete(synchronize_session=False)
+    for guild_id, guild_members in itertools.groupby(members, lambda member: member[0]):
+        subscriptions.delete_subscriptions(session, guild_id, [user_id for _guild_id, user_id in guild_members], subscriptions.KIND_RAID, raid_id)
+    return members
+
+def add_going(session, raid_id, triggered_by_id, members_list):
+    return insert_going(session, raid_id, with_party(session, triggered_by_id, members_list))
+
+def remove_going(session, raid_id, triggered_by_id, members_list):
+    return delete_going(session, raid_id, with_party(session, triggered_by_id, members_list))
+
+def flip_going(session, raid_id, triggered_by_id, members_list):
+    """
+        Add the members in members_list that aren't going to a raid and
+        remove the ones that are, returns (added, removed).
+    """
+    going = going_user_ids(session, raid_id)
+    to_add = [member for member in members_list if member[1] not in going]
+    to_remove = [member for member in members_list if member[1] in going]
+    added = []
+    if to_add:
+        added = insert_going(session, raid_id, with_party(session, triggered_by_id, to_add), going)
+    removed = remove_going(session, raid_id, triggered_by_id, to_remove)
+    return added, removed
+
+def add_extra(session, raid_id, user_id, extra):
+    session.query(models.RaidGoing).filter_by(raid_id=raid_id, user_id=user_id).update(
+        {models.RaidGoing.extra: func.greatest(models.RaidGoing.extra + extra, 0)},
+        synchronize_session=False
+    )
+
+def going_changed(cog, raid_id, added=[], removed=[]):
+    """
+        Bring the subscription index in line after going rows were
+        changed on the database pool.
+    """
+    for guild_id, user_id in added:
+        cog.subscriptions.set(guild_id, user_id, subscriptions.KIND_RAID, raid_id)
+    for guild_id, user_id in removed:
+        cog.subscriptions.discard(guild_id, user_id, subscriptions.KIND_RAID, raid_id)
+
+# The going helpers below run their database work as one unit on the
+# pool. The cogs session is committed first so it can't be holding locks
+# on the rows the unit changes.
+
 async def add_raid_going(cog, triggered_by, raid, members):
     members_list = [(member.guild.id, member.id, extra) for member, extra in members]
-    # If the user is adding themselves, include their party
-    if triggered_by.id in [member.id for member, extra in members]:
-        party_members = cog.session.query(models.Party).filter_by(creator_user_id=triggered_by.id)
-        for i, party_member in enumerate(party_members):
-            members_list.append((party_member.guild_id, party_member.user_id, party_member.extra))
-
-    for guild_id, member_id, extra in members_list:
-        count = cog.session.query(models.RaidGoing).filter_by(raid=raid, user_id=member_id).count()
-        if count != 0:
-            return
-        going = models.RaidGoing(
-            user_id=member_id,
-            guild_id=guild_id,
-            extra=extra,
-            raid=raid
-        )
-        guild = cog.bot.get_guild(guild_id)
-        member = guild.get_member(member_id)
-        await subscribe(member, _("Raid {} (#{})").format(raid.gym.title, raid.id))
-        cog.session.add(going)
+    if not members_list:
+        return
+    cog.session.commit()
+    added = await cog.db.run(add_going, raid.id, triggered_by.id, members_list)
+    going_changed(cog, raid.id, added=added)
 
 async def remove_raid_going(cog, triggered_by, raid, members):
-    members_list = [member.id for member in members]
-    # If the user is adding themselves, include their party
-    if triggered_by.id in members_list:
-        party_members = cog.session.query(models.Party).filter_by(creator_user_id=triggered_by.id)
-        for party_member in party_members:
-            members_list.append(party_member.user_id)
-
-    cog.session.query(models.RaidGoing).filter(
-        models.RaidGoing.raid == raid,
-        models.RaidGoing.user_id.in_(members_list)
-    ).delete(synchronize_session=False)
-    cog.session.expire_all()
-    for member in members:
-        await unsubscribe(member, _("Raid {} (#{})").format(raid.gym.title, raid.id))
+    members_list = [(member.guild.id, member.id, 0) for member in members]
+    if not members_list:
+        return
+    cog.session.commit()
+    removed = await cog.db.run(remove_going, raid.id, triggered_by.id, members_list)
+    going_changed(cog, raid.id, removed=removed)
 
 async def add_person(cog, triggered_by, raid, member, extra=1):
-    try:
-        going = cog.session.query(models.RaidGoing).filter_by(raid=raid, user_id=member.id).one()
-        going.extra = max(going.extra + extra, 0)
-        cog.session.add(going)
-    except NoResultFound:
-        return
+    cog.session.commit()
+    await cog.db.run(add_extra, raid.id, member.id, extra)
 
 async def toggle_going(cog, triggered_by, raid, members):
-    members_to_add = []
-    members_to_remove = []
-    for member in members:
-        try:
-            going = cog.session.query(models.RaidGoing).filter_by(raid=raid, user_id=member.id).one()
-            members_to_remove.append(member)
-        except NoResultFound:
-            members_to_add.append((member, 0))
-    await add_raid_going(cog, triggered_by, raid, members_to_add)
-    await remove_raid_going(cog, triggered_by, raid, members_to_remove)
+    members_list = [(member.guild.id, member.id, 0) for member in members]
+    cog.session.commit()
+    added, removed = await cog.db.run(flip_going, raid.id, triggered_by.id, members_list)
+    going_changed(cog, raid.id, added, removed)
 
 def find_role(guild, role_name):
-    for role in guild.roles:
-        if role.name == role_name:
-            return role
-    return None
+    return roles.find_role(guild, role_name)
 
 def member_in_role(member, role):
-    for role_ in member.roles:
-        if role_ == role:
-            return True
-    return False
-
-async def subscribe(member, role_name):
-    role = find_role(member.guild, role_name)
-    if role is None:
-        role = await member.guild.create_role(name=role_name, mentionable=True)
-    if member_in_role(member, role):
-        return False
-    await member.add_roles(role, reason=_("Added by Monord"))
-    return True
+    return role in member.roles
+
+def raid_role_name(raid):
+    return _("Raid {} (#{})").format(raid.gym.title, raid.id)
 
-async def subscribe_with_message(ctx, member, role_name):
-    subscribed = await subscribe(member, role_name)
+async def delete_role(cog, guild_id, role_id):
+    try:
+        await cog.bot.http.delete_role(guild_id, role_id, reason=_("Removed by Monord"))
+    except discord.errors.NotFound:
+        pass
+
+async def delete_raid_roles(cog, raid):
+    """
+        Delete any roles left for a raid from before subscriptions were
+        stored, found by name in each guilds role index. The sweeper
+        can't tell they're ours once the raid is deleted.
+    """
+    name = raid_role_name(raid)
+    tasks = []
+    for guild in cog.bot.guilds:
+        role = find_role(guild, name)
+        if role is not None:
+            tasks.append(delete_role(cog, guild.id, role.id))
+    await wait_for_tasks(tasks)
+
+async def subscribe_with_message(ctx, kind, target, name):
+    subscribed = ctx.cog.subscriptions.subscribe(ctx.cog.session, ctx.guild.id, ctx.author.id, kind, target)
     if subscribed:
-        await ctx.send(_("You are now subscribed to {}").format(role_name))
+        await ctx.send(_("You are now subscribed to {}").format(name))
     else:
-        await ctx.send(_("You are already subscribed to {}").format(role_name))
+        await ctx.send(_("You are already subscribed to {}").format(name))
 
-async def unsubscribe(member, role_name):
-    role = find_role(member.guild, role_name)
-    if role is None:
-        return False
-    for role_ in member.roles:
-        if role_ == role:
-            await member.remove_roles(role, reason=_("Removed by Monord"))
-            if not role.members:
-                await role.delete(reason=_("Removed by Monord, role is empty"))
-            return True
-    return False
-
-async def unsubscribe_with_message(ctx, member, role_name):
-    unsubscribed = await unsubscribe(member, role_name)
+async def unsubscribe_with_message(ctx, kind, target, name):
+    unsubscribed = ctx.cog.subscriptions.unsubscribe(ctx.cog.session, ctx.guild.id, ctx.author.id, kind, target)
     if unsubscribed:
-        await ctx.send(_("You have been unsubscribed from {}").format(role_name))
+        await ctx.send(_("You have been unsubscribed from {}").format(name))
     else:
-        await ctx.send(_("You are not subscribed to {}").format(role_name))
+        await ctx.send(_("You are not subscribed to {}").format(name))
 
 async def hide_raid(cog, channel, raid):
     embeds = list(cog.session.query(models.Embed).filter_by(channel_id=channel.id, raid=raid))
     cog.session.query(models.Embed).filter_by(channel_id=channel.id, raid=raid).delete()
-    for embed in embeds:
-        try:
-            message = await channel.get_message(embed.message_id)
-            await message.delete()
-        except discord.errors.NotFound:
-            pass
+    cog.tracked_messages.difference_update(embed.message_id for embed in embeds)
+    await wait_for_tasks([cog.messages.delete(channel.id, embed.message_id) for embed in embeds])
 
 async def mark_raid_despawned(cog, raid):
     raid.despawned = True
 
-    tasks = []
-
-    for guild in cog.bot.guilds:
-        role = find_role(guild, _("Raid {} (#{})").format(raid.gym.title, raid.id))
-        if role is not None:
-            tasks.append(role.delete(reason=_("Removed by Monord")))
-    await wait_for_tasks(tasks)
+    cog.raid_bodies.forget(raid.id)
+    await cog.subscriptions.forget(cog.db, subscriptions.KIND_RAID, raid.id)
@@ -1,26 +1,290 @@
+from . import gymindex
+from . import importer
+from . import metrics
+from . import models
+from . import timers
+from . import utils
 from aiohttp import web
+from os import environ
+import asyncio
+import datetime
+import logging
+import pytz
+import time
+logger = logging.getLogger()
+
+# Raid events waiting to be written, once full the webhook answers 503
+# so the scanner backs off and retries.
+WEBHOOK_QUEUE_SIZE = int(environ.get('WEBHOOK_QUEUE_SIZE') or 1000)
+# Most events handled in one database round.
+WEBHOOK_BATCH_SIZE = int(environ.get('WEBHOOK_BATCH_SIZE') or 100)
+# Whether to create gyms the webhook doesn't know about.
+WEBHOOK_CREATE_GYMS = (environ.get('WEBHOOK_CREATE_GYMS') or "yes").lower() in ["yes", "true", "1"]
+# Seconds a scanner should wait before retrying a rejected request.
+RETRY_AFTER = 5
+
+
+def event_time(message):
+    return datetime.datetime.fromtimestamp(message["end"], pytz.utc)
+
+
+def event_key(message):
+    return message["gym_id"], message["end"]
+
+
+def find_raid(raids, time):
+    """
+        In memory version of utils.get_raid_at_time.
+    """
+    earliest = timers.naive_utc(time - utils.HATCH_TIME - utils.DESPAWN_TIME)
+    latest = timers.naive_utc(time + utils.HATCH_TIME + utils.DESPAWN_TIME)
+    for raid in raids:
+        if earliest <= timers.naive_utc(raid.despawn_time) <= latest:
+            return raid
+    return None
 
 
 class Webhook:
-    def __init__(self, bot):
-        self.bot = bot
+    """
+        Receives raids from MAD. Requests are answered as soon as their
+        events are queued, a single consumer then writes them in batches.
+
+        Events are deduplicated by (gym_id, end), scanners resend a raid
+        every time they see it. An event that names the boss of a raid
+        only seen as an egg is let through so the raid can hatch.
+    """
+    def __init__(self, cog):
+        self.cog = cog
+        self.bot = cog.bot
+        self.queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.seen = {}
+        self.gyms = gymindex.GymIndex()
+        self.importer = importer.Importer()
+        # Gyms are only ever created with an id, so the importer doesn't
+        # need to load every gym location to match on.
+        self.importer.locations = {}
+        self.pruned = time.time()
+        self.consumer = None
+        self.runner = None
+        self.stats = {
+            "received": 0,
+            "queued": 0,
+            "dropped": 0,
+            "duplicates": 0,
+            "invalid": 0,
+            "expired": 0,
+            "unknown_gym": 0,
+            "gyms_cached": 0,
+            "gyms_matched": 0,
+            "gyms_created": 0,
+            "created": 0,
+            "hatched": 0,
+            "updated": 0,
+            "batches": 0,
+            "errors": 0,
+        }
 
     async def mad_handler(self, request):
         #[{'message': {'latitude': 51.359126, 'longitude': 1.445414, 'level': 5, 'team_id': 1, 'start': 1553340120, 'end': 1553342820, 'gym_id': '48eefa6527344ef282c74181a7074399.16', 'name': 'The Scotsman', 'url': 'http://lh5.ggpht.com/YfMW7LqOgdcPigk06UWbYqLYm6VY2wQ9I6l_lVTkaeeoCDWEFQ3wItFZj3-f_CPtcYrf-5q6sVuvsfhNNlA', 'pokemon_id': 0, 'sponsor': '0', 'weather': '0', 'park': 'None'}, 'type': 'raid'}]
-        #print(request)
-        #print(dir(request))
-        #print(await request.json())
-        events = await request.json()
+        try:
+            events = await request.json()
+        except ValueError:
+            self.stats["invalid"] += 1
+            return web.Response(status=400)
+        if not isinstance(events, list):
+            events = [events]
+        dropped = 0
         for event in events:
-            if event['type'] == 'raid':
-                pass
-        return web.Response()
+            if not isinstance(event, dict) or event.get('type') != 'raid':
+                continue
+            self.stats["received"] += 1
+            message = event.get('message')
+            try:
+                # Some scanners send numbers as strings.
+                message["end"] = int(message["end"])
+                message["level"] = int(message["level"])
+                message["pokemon_id"] = int(message.get("pokemon_id") or 0)
+            except (TypeError, KeyError, ValueError):
+                self.stats["invalid"] += 1
+                continue
+            key = event_key(message)
+            pokemon_id = message["pokemon_id"]
+            if key in self.seen and (pokemon_id == 0 or self.seen[key] == pokemon_id):
+                self.stats["duplicates"] += 1
+                continue
+            try:
+                self.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1
+                dropped += 1
+                continue
+            self.seen[key] = pokemon_id
+            self.stats["queued"] += 1
+        if dropped:
+            return web.Response(status=503, headers={"Retry-After": str(RETRY_AFTER)})
+        return web.Response(status=202)
+
+    def prune(self):
+        now = time.time()
+        if now - self.pruned < 60:
+            return
+        self.pruned = now
+        self.seen = {key: value for key, value in self.seen.items() if key[1] > now}
+
+    async def consume(self):
+        # Until the gym index is loaded every gym would look new.
+        while not self.gyms.loaded:
+            await asyncio.sleep(1)
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < WEBHOOK_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.handle(batch)
+            self.prune()
+
+    async def handle(self, batch):
+        try:
+            await self.process(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            self.cog.session.rollback()
+            # Let the scanners resends through, the batch was lost.
+            for message in batch:
+                self.seen.pop(event_key(message), None)
+            logger.exception("Error processing {} webhook events".format(len(batch)))
+        self.stats["batches"] += 1
+
+    async def process(self, messages):
+        """
+            Create or hatch the raids for a batch of events, reading the
+            gyms, pokemon and existing raids they need in three queries.
+        """
+        cog = self.cog
+        session = cog.session
+        now = pytz.utc.localize(datetime.datetime.utcnow())
+        events = []
+        for message in messages:
+            despawn_time = event_time(message)
+            if despawn_time <= now:
+                self.stats["expired"] += 1
+                continue
+            events.append((message, despawn_time))
+        if not events:
+            return
+
+        resolved = await self.resolve_gyms([message for message, despawn_time in events])
+        gym_ids = set(resolved.values()) - {None}
+        if not gym_ids:
+            self.stats["unknown_gym"] += len(events)
+            return
+        gyms = {gym.id: gym for gym in session.query(models.Gym).filter(models.Gym.id.in_(gym_ids))}
+        pokemon_ids = {message.get("pokemon_id") for message, despawn_time in events if message.get("pokemon_id")}
+        pokemons = {}
+        if pokemon_ids:
+            pokemons = {pokemon.id: pokemon for pokemon in session.query(models.Pokemon).filter(models.Pokemon.id.in_(pokemon_ids))}
+        window = utils.HATCH_TIME + utils.DESPAWN_TIME
+        raids = {}
+        query = session.query(models.Raid).filter(
+            models.Raid.despawned == False,
+            models.Raid.gym_id.in_(gyms.keys()),
+            models.Raid.despawn_time >= min(despawn_time for message, despawn_time in events) - window,
+            models.Raid.despawn_time <= max(despawn_time for message, despawn_time in events) + window
+        )
+        for raid in query:
+            raids.setdefault(raid.gym_id, []).append(raid)
+
+        created, hatched, changed = [], {}, []
+        for message, despawn_time in events:
+            gym = gyms.get(resolved[message["gym_id"]])
+            if gym is None:
+                self.stats["unknown_gym"] += 1
+                continue
+            pokemon = pokemons.get(message.get("pokemon_id"))
+            raid = find_raid(raids.get(gym.id, []), despawn_time)
+            if raid is None:
+                raid = utils.build_raid(cog, despawn_time, pokemon or message["level"], gym, bool(message.get("is_exclusive", False)))
+                session.add(raid)
+                raids.setdefault(gym.id, []).append(raid)
+                created.append(raid)
+            elif pokemon is None or raid.pokemon == pokemon:
+                continue
+            elif raid in created:
+                raid.pokemon = pokemon
+                raid.hatched = True
+            elif raid in hatched or raid.pokemon is None:
+                hatched[raid] = pokemon
+            else:
+                raid.pokemon = pokemon
+                if raid not in changed:
+                    changed.append(raid)
+        session.commit()
+
+        self.stats["created"] += len(created)
+        self.stats["hatched"] += len(hatched)
+        self.stats["updated"] += len(changed)
+        tasks = [utils.broadcast_raid(cog, raid) for raid in created]
+        tasks += [utils.hatch_raid(cog, raid, pokemon) for raid, pokemon in hatched.items()]
+        for raid in changed:
+            utils.raid_changed(cog, raid)
+            tasks.append(cog.updates.request(raid))
+        await utils.wait_for_tasks(tasks)
+
+    async def resolve_gyms(self, messages):
+        """
+            Map the scanner gym ids in messages to our gym ids, using the
+            gym index. Gyms that aren't known are created with one bulk
+            import for the whole batch.
+        """
+        cog = self.cog
+        resolved = {}
+        new = {}
+        for message in messages:
+            id = message["gym_id"]
+            if id in resolved:
+                continue
+            cached = id in self.gyms.resolved
+            resolved[id] = self.gyms.resolve(id, message.get("latitude"), message.get("longitude"))
+            if resolved[id] is not None:
+                self.stats["gyms_cached" if cached else "gyms_matched"] += 1
+            elif WEBHOOK_CREATE_GYMS and message.get("latitude") is not None and message.get("longitude") is not None:
+                new[id] = {"type": "gym", "data": {
+                    "id": id,
+                    "title": message.get("name") or id,
+                    "latitude": message["latitude"],
+                    "longitude": message["longitude"],
+                }}
+        if new:
+            await cog.db.run(self.importer.run, list(new.values()))
+            for id, entry in new.items():
+                data = entry["data"]
+                self.gyms.add(id, data["latitude"], data["longitude"])
+                cog.matcher.add_gym(id, data["title"], data["latitude"], data["longitude"])
+                resolved[id] = self.gyms.resolve(id)
+            self.stats["gyms_created"] += len(new)
+        return resolved
+
+    async def metrics_handler(self, request):
+        return web.Response(text=metrics.registry.render(), content_type="text/plain")
+
+    def info(self):
+        return dict(self.stats, queue=self.queue.qsize(), seen=len(self.seen))
 
     async def webserver(self):
         app = web.Application()
         app.router.add_post('/wh/mad', self.mad_handler)
-        runner = web.AppRunner(app)
-        await runner.setup()
-        self.site = web.TCPSite(runner, '0.0.0.0', 8999)
+        app.router.add_get('/metrics', self.metrics_handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '0.0.0.0', 8999)
         await self.bot.wait_until_ready()
-        await self.site.start()
+        self.consumer = self.bot.loop.create_task(self.consume())
+        await site.start()
+
+    async def stop(self):
+        if self.consumer is not None:
+            self.consumer.cancel()
+        if self.runner is not None:
+            # Stops the site as well.
+            await self.runner.cleanup()
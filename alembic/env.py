@@ -53,7 +53,15 @@ def run_migrations_online():
     In this scenario we need to create an Engine
     and associate a connection with the context.
 
+    A connection can be passed in config.attributes, the tests use
+    this to migrate inside a transaction they roll back.
+
     """
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        run_migrations_with(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         url=environ['POSTGRES_CS'],
@@ -61,13 +69,17 @@ def run_migrations_online():
         poolclass=pool.NullPool)
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata
-        )
+        run_migrations_with(connection)
 
-        with context.begin_transaction():
-            context.run_migrations()
+
+def run_migrations_with(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
 
 if context.is_offline_mode():
     run_migrations_offline()
@@ -0,0 +1,44 @@
+"""Add spatial and query indexes
+
+Revision ID: 5d2f8a9c1e47
+Revises: 42772ba80b82
+Create Date: 2026-10-18 10:12:41.530117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f8a9c1e47'
+down_revision = '42772ba80b82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Dropped by 091a10492adb, GeoAlchemy may have already recreated them.
+    op.execute('CREATE INDEX IF NOT EXISTS idx_gym_location ON gym USING gist (location)')
+    op.execute('CREATE INDEX IF NOT EXISTS idx_guildconfig_region ON guildconfig USING gist (region)')
+
+    op.create_index('ix_raid_despawned_hatched_despawn_time', 'raid', ['despawned', 'hatched', 'despawn_time'], unique=False)
+    op.create_index('ix_raid_active_despawn_time', 'raid', ['despawn_time'], unique=False, postgresql_where=sa.text('despawned = false'))
+    op.create_index('ix_raid_gym_id_despawn_time', 'raid', ['gym_id', 'despawn_time'], unique=False)
+    op.create_index('ix_embed_channel_id_message_id', 'embed', ['channel_id', 'message_id'], unique=False)
+    op.create_index('ix_embed_raid_id_embed_type', 'embed', ['raid_id', 'embed_type'], unique=False)
+    op.create_index('ix_embed_delete_at', 'embed', ['delete_at'], unique=False, postgresql_where=sa.text('delete_at IS NOT NULL'))
+    op.create_index('ix_gymalias_guild_id_title', 'gymalias', ['guild_id', 'title'], unique=False)
+    op.create_index('ix_guildconfig_guild_id_channel_id', 'guildconfig', ['guild_id', 'channel_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_guildconfig_guild_id_channel_id', table_name='guildconfig')
+    op.drop_index('ix_gymalias_guild_id_title', table_name='gymalias')
+    op.drop_index('ix_embed_delete_at', table_name='embed')
+    op.drop_index('ix_embed_raid_id_embed_type', table_name='embed')
+    op.drop_index('ix_embed_channel_id_message_id', table_name='embed')
+    op.drop_index('ix_raid_gym_id_despawn_time', table_name='raid')
+    op.drop_index('ix_raid_active_despawn_time', table_name='raid')
+    op.drop_index('ix_raid_despawned_hatched_despawn_time', table_name='raid')
+    op.drop_index('idx_guildconfig_region', table_name='guildconfig')
+    op.drop_index('idx_gym_location', table_name='gym')
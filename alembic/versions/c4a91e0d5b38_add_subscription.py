@@ -0,0 +1,32 @@
+"""Add subscription
+
+Revision ID: c4a91e0d5b38
+Revises: 5d2f8a9c1e47
+Create Date: 2026-10-18 16:41:09.552817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a91e0d5b38'
+down_revision = '5d2f8a9c1e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('subscription',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=True),
+    sa.Column('guild_id', sa.BigInteger(), nullable=True),
+    sa.Column('kind', sa.String(), nullable=True),
+    sa.Column('target', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'guild_id', 'kind', 'target', name='_subscription_uc')
+    )
+
+
+def downgrade():
+    op.drop_table('subscription')
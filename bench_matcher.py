@@ -0,0 +1,109 @@
+"""
+    Compare the in process matcher (Monord/fuzzy.py) against Elasticsearch,
+    for match latency and whether both return the same result.
+
+    Queries are every pokemon name (and every gym title inside --region),
+    with a typo added to each.
+
+    usage: POSTGRES_CS=... python bench_matcher.py [--region '[[[lon, lat], ...]]']
+"""
+from Monord import fuzzy
+from Monord import es_models  # sets up the Elasticsearch connection
+from elasticsearch_dsl import Search
+from geoalchemy2.shape import from_shape
+from shapely.geometry import shape
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from os import environ
+import argparse
+import json
+import random
+import time
+
+
+def typo(text, rng):
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    return text[:i] + text[i + 1:]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(kind, local_times, es_times, same, total):
+    print("{}: {} queries".format(kind, total))
+    for name, times in [("local", local_times), ("elasticsearch", es_times)]:
+        print("  {:<14} p50 {:.2f}ms  p95 {:.2f}ms  max {:.2f}ms".format(
+            name,
+            percentile(times, 0.5) * 1000,
+            percentile(times, 0.95) * 1000,
+            max(times) * 1000
+        ))
+    print("  same result for {} / {} ({:.1f}%)".format(same, total, 100.0 * same / total))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_pokemon(matcher, rng):
+    local_times, es_times, same = [], [], 0
+    names = [name for name, length in matcher.pokemon.names.values()]
+    for name in names:
+        query = typo(name, rng)
+        local, local_time = timed(matcher.find_pokemon, query)
+        response, es_time = timed(Search(index="pokemon").query("match", name={'query': query, 'fuzziness': 2}).execute)
+        local_times.append(local_time)
+        es_times.append(es_time)
+        es_id = int(response[0].meta["id"]) if response.hits.total else None
+        if (local[0] if local else None) == es_id:
+            same += 1
+    report("pokemon", local_times, es_times, same, len(names))
+
+
+def bench_gyms(matcher, rng, region_json):
+    region = shape({"type": "Polygon", "coordinates": json.loads(region_json)})
+    wkb = from_shape(region, srid=4326)
+    points = [{"lat": y, "lon": x} for x, y in region.exterior.coords]
+    local_times, es_times, same = [], [], 0
+    titles = [title for title, length in matcher.partition(wkb).names.values()]
+    for title in titles:
+        query = typo(title, rng)
+        local, local_time = timed(matcher.find_gym, query, wkb)
+        s = Search(index="gym").query("match", title={'query': query, 'fuzziness': 2})
+        s = s.filter("geo_polygon", location={"points": points})
+        response, es_time = timed(s.execute)
+        local_times.append(local_time)
+        es_times.append(es_time)
+        es_id = response[0].meta["id"] if response.hits.total else None
+        if (local[0] if local else None) == es_id:
+            same += 1
+    if titles:
+        report("gyms", local_times, es_times, same, len(titles))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local matcher against Elasticsearch")
+    parser.add_argument("--region", help="Polygon to search gyms in, same format as the region setting")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    engine = create_engine(environ.get('POSTGRES_CS'), connect_args={"options": "-c timezone=utc"})
+    session = sessionmaker(bind=engine)()
+    start = time.perf_counter()
+    matcher = fuzzy.build_matcher(session)
+    print("Built matcher in {:.2f}s".format(time.perf_counter() - start))
+
+    rng = random.Random(args.seed)
+    bench_pokemon(matcher, rng)
+    if args.region:
+        bench_gyms(matcher, rng, args.region)
+
+
+if __name__ == "__main__":
+    main()
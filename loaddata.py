@@ -0,0 +1,122 @@
+"""
+    Load pokemon and gyms from a json file without starting the bot,
+    using the same importer as the loaddata command.
+
+    usage: POSTGRES_CS=... python loaddata.py gyms.json [--workers 4] [--dry-run]
+
+    A running bot keeps gyms and pokemon in memory, run its reloadindexes
+    command (or restart it) after importing.
+"""
+from Monord import importer
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from os import environ
+import argparse
+import itertools
+import multiprocessing
+import sys
+import time
+
+worker = {}
+
+RELOAD_NOTE = "If the bot is running, run its reloadindexes command (or restart it) to pick up the imported data."
+
+
+def make_session():
+    engine = create_engine(environ.get('POSTGRES_CS'), connect_args={"options": "-c timezone=utc"})
+    return sessionmaker(bind=engine)()
+
+
+def batches(entries, size):
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, size))
+        if not batch:
+            return
+        yield batch
+
+
+def init_worker(batch_size, index):
+    worker["session"] = make_session()
+    worker["importer"] = importer.Importer(batch_size, index)
+
+
+def import_batch(batch):
+    job = worker["importer"]
+    before = dict(job.counts)
+    job.run(worker["session"], batch)
+    return {key: job.counts[key] - before[key] for key in before}
+
+
+def load(args):
+    if not args.no_index:
+        # Once here rather than in every worker, which only need the connection.
+        from Monord import es_models
+        es_models.init()
+    start = time.monotonic()
+    counts = {"gym": 0, "pokemon": 0, "skipped": 0}
+    with open(args.path, "r") as f:
+        entries = importer.iter_entries(f)
+        if args.workers == 1:
+            init_worker(args.batch_size, not args.no_index)
+            results = map(import_batch, batches(entries, args.batch_size))
+            for result in results:
+                report(counts, result, start)
+        else:
+            # Spawn rather than fork, so every worker opens its own
+            # Postgres and Elasticsearch connections.
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(args.workers, init_worker, (args.batch_size, not args.no_index)) as pool:
+                for result in pool.imap_unordered(import_batch, batches(entries, args.batch_size)):
+                    report(counts, result, start)
+    print(importer.summary(counts, time.monotonic() - start))
+    print(RELOAD_NOTE)
+
+
+def report(counts, result, start):
+    for key in counts:
+        counts[key] += result[key]
+    elapsed = time.monotonic() - start
+    print("{} gyms, {} pokemon ({:.0f} rows/s)".format(
+        counts["gym"],
+        counts["pokemon"],
+        (counts["gym"] + counts["pokemon"]) / elapsed if elapsed else 0.0
+    ), file=sys.stderr)
+
+
+def dry_run(args):
+    totals = {}
+    with open(args.path, "r") as f:
+        changes = importer.Importer().diff(make_session(), importer.iter_entries(f))
+        for status, kind, id, columns in changes:
+            totals.setdefault(kind, {"new": 0, "changed": 0, "unchanged": 0})[status] += 1
+            if status == "new":
+                print("+ {} {}".format(kind, id))
+            elif status == "changed":
+                print("~ {} {}".format(kind, id))
+            elif args.verbose:
+                print("= {} {}".format(kind, id))
+            for column, (old, new) in sorted(columns.items()):
+                print("    {}: {!r} -> {!r}".format(column, old, new))
+    for kind, counts in sorted(totals.items()):
+        print("{}: {} new, {} changed, {} unchanged".format(kind, counts["new"], counts["changed"], counts["unchanged"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load pokemon and gyms into Postgres and Elasticsearch", epilog=RELOAD_NOTE)
+    parser.add_argument("path", help="json file in the same format as the loaddata command")
+    parser.add_argument("--workers", type=int, default=1, help="processes to import batches with")
+    parser.add_argument("--batch-size", type=int, default=importer.BATCH_SIZE)
+    parser.add_argument("--no-index", action="store_true", help="don't update Elasticsearch")
+    parser.add_argument("--dry-run", action="store_true", help="print what would change and exit")
+    parser.add_argument("--verbose", action="store_true", help="with --dry-run, also list unchanged rows")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        dry_run(args)
+    else:
+        load(args)
+
+
+if __name__ == "__main__":
+    main()
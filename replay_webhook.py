@@ -0,0 +1,80 @@
+"""
+    Replay captured MAD webhook events against a running bot.
+
+    The input is a json list of events in the format MAD posts them,
+    [{"type": "raid", "message": {...}}, ...]. Requests rejected with
+    503 are retried after the Retry-After delay.
+
+    usage: python replay_webhook.py events.json [--url http://localhost:8999/wh/mad] [--batch 50] [--rate 10] [--shift]
+"""
+import aiohttp
+import argparse
+import asyncio
+import json
+import time
+
+
+def shift_times(events):
+    """
+        Move every event forward so the earliest one starts now, old
+        captures would otherwise be thrown away as expired.
+    """
+    starts = [event["message"]["start"] for event in events if "start" in event.get("message", {})]
+    if not starts:
+        return
+    offset = int(time.time()) - min(starts)
+    for event in events:
+        for key in ["start", "end"]:
+            if key in event.get("message", {}):
+                event["message"][key] += offset
+
+
+async def post(session, url, batch, statuses):
+    while True:
+        async with session.post(url, json=batch) as response:
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            if response.status != 503:
+                return
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+
+async def replay(args, events):
+    statuses = {}
+    batches = [events[i:i + args.batch] for i in range(0, len(events), args.batch)]
+    start = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        for i, batch in enumerate(batches):
+            if args.rate:
+                # Keep to the requested rate without waiting on responses.
+                delay = start + i / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(post(session, args.url, batch, statuses)))
+        await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+    print("Sent {} events in {} requests in {:.2f}s ({:.0f} events/s)".format(
+        len(events), len(batches), elapsed, len(events) / elapsed if elapsed else 0
+    ))
+    for status, count in sorted(statuses.items()):
+        print("  {}: {}".format(status, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay MAD webhook events")
+    parser.add_argument("path", help="json file of events")
+    parser.add_argument("--url", default="http://localhost:8999/wh/mad")
+    parser.add_argument("--batch", type=int, default=50, help="events per request")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, 0 for as fast as possible")
+    parser.add_argument("--shift", action="store_true", help="move event times so the first event starts now")
+    args = parser.parse_args()
+
+    with open(args.path, "r") as f:
+        events = json.load(f)
+    if args.shift:
+        shift_times(events)
+    asyncio.get_event_loop().run_until_complete(replay(args, events))
+
+
+if __name__ == "__main__":
+    main()
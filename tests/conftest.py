@@ -0,0 +1,75 @@
+"""
+    Tests that need Postgres use the session fixture, which is skipped
+    unless DATABASE_URL points at a PostGIS database. The schema is
+    created from the models inside a transaction that is rolled back
+    afterwards, so an empty scratch database is best.
+
+    migrated_session is the same, but builds the schema by running the
+    alembic migrations as production does.
+"""
+from Monord import models
+from alembic import command
+from alembic.config import Config
+from os import environ, path
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import pytest
+
+DATABASE_URL = environ.get('DATABASE_URL')
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+@pytest.fixture
+def connection():
+    if not DATABASE_URL:
+        pytest.skip("DATABASE_URL is not set")
+    engine = create_engine(DATABASE_URL, connect_args={"options": "-c timezone=utc"})
+    connection = engine.connect()
+    transaction = connection.begin()
+    connection.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+        engine.dispose()
+
+
+def make_session(connection):
+    session = sessionmaker(bind=connection)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def session(connection):
+    models.Base.metadata.create_all(connection)
+    yield from make_session(connection)
+
+
+@pytest.fixture
+def migrated_session(connection):
+    config = Config(path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", path.join(ROOT, "alembic"))
+    config.attributes["connection"] = connection
+    command.upgrade(config, "head")
+    yield from make_session(connection)
+
+
+@pytest.fixture
+def statements(session):
+    """
+        Every statement sent to the database while the test runs.
+    """
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(session.bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield executed
+    finally:
+        event.remove(session.bind, "before_cursor_execute", before_cursor_execute)
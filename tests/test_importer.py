@@ -0,0 +1,15 @@
+from Monord import importer
+import io
+import pytest
+
+ENTRIES = '[{"type": "pokemon", "data": {"id": "001"}}, 2.5, -1e3, 12, true]'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 64])
+def test_iter_entries_across_chunks(chunk_size):
+    entries = list(importer.iter_entries(io.StringIO(ENTRIES), chunk_size))
+    assert entries == [{"type": "pokemon", "data": {"id": "001"}}, 2.5, -1e3, 12, True]
+
+
+def test_pokemon_row_without_types_keeps_them():
+    assert "types" not in importer.pokemon_row({"id": "001", "name": "Bulbasaur"})
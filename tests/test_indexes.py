@@ -0,0 +1,93 @@
+"""
+    The hot filters should be answered from the indexes added in
+    5d2f8a9c1e47 (and declared in models.py), checked with EXPLAIN on a
+    seeded PostGIS database. The schema is built both from the models and
+    by running the migrations, so the two can't drift apart.
+
+    Gym ids are seeded as numbers, the migrations still declare gym.id as
+    an integer while the models use a string.
+"""
+from Monord import models
+from sqlalchemy import inspect
+import pytest
+
+SEED = [
+    """INSERT INTO gym (id, title, location, ex)
+        SELECT i, 'Gym ' || i, ST_SetSRID(ST_MakePoint(-0.5 + i * 0.001, 51.2 + i * 0.001), 4326), false
+        FROM generate_series(1, 1000) i""",
+    """INSERT INTO raid (gym_id, despawn_time, start_time, level, ex, hatched, despawned, cancelled)
+        SELECT mod(i, 1000) + 1, now()::timestamp - i * interval '1 minute', now()::timestamp - i * interval '1 minute',
+            5, false, i > 100, i > 50, false
+        FROM generate_series(1, 10000) i""",
+    """INSERT INTO embed (channel_id, message_id, raid_id, embed_type, delete_at)
+        SELECT mod(id, 20), id, id, 1, CASE WHEN mod(id, 100) = 0 THEN now()::timestamp ELSE NULL END
+        FROM raid""",
+    """INSERT INTO raidgoing (user_id, guild_id, extra, raid_id)
+        SELECT id * 10 + n, 1, 0, id FROM raid, generate_series(1, 3) n""",
+    """INSERT INTO party (creator_user_id, user_id, guild_id, extra)
+        SELECT mod(i, 500), i, 1, 0 FROM generate_series(1, 5000) i""",
+    """INSERT INTO gymalias (title, gym_id, guild_id)
+        SELECT 'alias ' || i, mod(i, 1000) + 1, mod(i, 20) FROM generate_series(1, 5000) i""",
+    """INSERT INTO guildconfig (guild_id, channel_id, region)
+        SELECT mod(i, 50), i, ST_MakeEnvelope(-0.5 + i * 0.001, 51.2 + i * 0.001, -0.49 + i * 0.001, 51.21 + i * 0.001, 4326)
+        FROM generate_series(1, 5000) i""",
+]
+
+# (query, indexes any of which may answer it)
+QUERIES = [
+    (
+        "SELECT id FROM raid WHERE despawned = false AND despawn_time <= now()::timestamp",
+        ["ix_raid_active_despawn_time", "ix_raid_despawned_hatched_despawn_time"]
+    ),
+    (
+        "SELECT id FROM raid WHERE despawned = false AND hatched = false AND despawn_time <= now()::timestamp",
+        ["ix_raid_despawned_hatched_despawn_time", "ix_raid_active_despawn_time"]
+    ),
+    (
+        "SELECT id FROM raid WHERE gym_id = '7' AND despawn_time >= now()::timestamp - interval '2 hours'",
+        ["ix_raid_gym_id_despawn_time"]
+    ),
+    ("SELECT id FROM embed WHERE channel_id = 3 AND message_id = 403", ["ix_embed_channel_id_message_id"]),
+    ("SELECT id FROM embed WHERE raid_id = 42 AND embed_type = 1", ["ix_embed_raid_id_embed_type"]),
+    ("SELECT id, delete_at FROM embed WHERE delete_at IS NOT NULL", ["ix_embed_delete_at"]),
+    ("SELECT id FROM raidgoing WHERE raid_id = 42", ["_raid_id_user_uc"]),
+    ("SELECT id FROM party WHERE creator_user_id = 42", ["_creator_user_id_user_id_uc"]),
+    ("SELECT id FROM gymalias WHERE guild_id = 3 AND title = 'alias 43'", ["ix_gymalias_guild_id_title"]),
+    ("SELECT id FROM guildconfig WHERE guild_id = 3 AND channel_id = 53", ["ix_guildconfig_guild_id_channel_id"]),
+    (
+        "SELECT id FROM gym WHERE ST_DWithin(location, ST_SetSRID(ST_MakePoint(-0.3, 51.4), 4326), 0.002)",
+        ["idx_gym_location"]
+    ),
+    (
+        "SELECT id FROM guildconfig WHERE ST_Contains(region, ST_SetSRID(ST_MakePoint(-0.3, 51.4), 4326))",
+        ["idx_guildconfig_region"]
+    ),
+]
+
+
+@pytest.fixture(params=["session", "migrated_session"])
+def seeded(request):
+    session = request.getfixturevalue(request.param)
+    for statement in SEED:
+        session.execute(statement)
+    for table in ["gym", "raid", "embed", "raidgoing", "party", "gymalias", "guildconfig"]:
+        session.execute("ANALYZE {}".format(table))
+    return session
+
+
+@pytest.mark.parametrize("query,indexes", QUERIES)
+def test_query_uses_index(seeded, query, indexes):
+    plan = "\n".join(row[0] for row in seeded.execute("EXPLAIN " + query))
+    assert "Seq Scan" not in plan, plan
+    assert any(index in plan for index in indexes), plan
+
+
+def test_migrations_create_model_indexes(migrated_session):
+    inspector = inspect(migrated_session.bind)
+    for table in models.Base.metadata.sorted_tables:
+        if not table.indexes:
+            continue
+        migrated = {index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            assert index.name in migrated, index.name
+            assert migrated[index.name] == [column.name for column in index.columns], index.name
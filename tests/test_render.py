@@ -0,0 +1,42 @@
+from Monord import models
+from Monord import render
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+import datetime
+
+
+def test_fetch_raid_going_is_one_query(session, statements):
+    gym = models.Gym(id="test-gym", title="Test Gym", location=from_shape(Point(-0.1, 51.5), srid=4326), ex=False)
+    pokemon = models.Pokemon(id=99150, name="Mewtwo", raid_level=5)
+    despawn_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+    raid = models.Raid(gym=gym, pokemon=pokemon, despawn_time=despawn_time, start_time=despawn_time, level=5)
+    session.add(raid)
+    session.add_all(models.RaidGoing(raid=raid, user_id=user_id, guild_id=1, extra=user_id % 3) for user_id in range(20))
+    session.flush()
+    raid_id = raid.id
+    session.expire_all()
+
+    del statements[:]
+    going = render.fetch_raid_going(session, raid_id)
+    raid = session.query(models.Raid).get(raid_id)
+    assert raid.gym.title == "Test Gym"
+    assert raid.pokemon.name == "Mewtwo"
+    assert sorted(row.user_id for row in going.rows) == list(range(20))
+    assert going.count == 20
+    assert going.extra == sum(user_id % 3 for user_id in range(20))
+    assert len(statements) == 1
+
+
+def test_fetch_raid_going_without_going(session, statements):
+    gym = models.Gym(id="test-gym", title="Test Gym", location=from_shape(Point(-0.1, 51.5), srid=4326), ex=False)
+    despawn_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+    raid = models.Raid(gym=gym, despawn_time=despawn_time, start_time=despawn_time, level=5)
+    session.add(raid)
+    session.flush()
+    raid_id = raid.id
+    session.expire_all()
+
+    del statements[:]
+    going = render.fetch_raid_going(session, raid_id)
+    assert going == render.GoingSummary([], 0, 0)
+    assert len(statements) == 1
@@ -0,0 +1,21 @@
+import re
+from Monord import subscriptions
+
+
+def mentioned(contents):
+    return [int(user_id) for content in contents for user_id in re.findall(r"<@(\d+)>", content)]
+
+
+def test_mention_users_mentions_everyone():
+    user_ids = [100000000000000000 + i for i in range(300)]
+    contents = subscriptions.mention_users(user_ids, "<@&1234>", 1500)
+    assert len(contents) > 1
+    assert sorted(mentioned(contents)) == user_ids
+    assert contents[0].startswith("<@&1234> ")
+    assert len(contents[0]) <= 1500
+    assert all(len(content) <= subscriptions.MAX_CONTENT_LENGTH for content in contents)
+
+
+def test_mention_users_nothing_to_send():
+    assert subscriptions.mention_users([]) == []
+    assert subscriptions.mention_users([], "prefix") == ["prefix"]
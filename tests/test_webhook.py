@@ -0,0 +1,169 @@
+from Monord import models
+from Monord import utils
+from Monord import webhook
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+from types import SimpleNamespace
+import asyncio
+import datetime
+import pytz
+import time
+
+
+class Request:
+    def __init__(self, body):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+class Database:
+    def __init__(self, session):
+        self.session = session
+
+    async def run(self, func, *args):
+        return func(self.session, *args)
+
+
+def make_cog(session=None):
+    return SimpleNamespace(
+        bot=None,
+        session=session,
+        db=Database(session),
+        availability=SimpleNamespace(possible=lambda *args: []),
+        regions=SimpleNamespace(regions_for=lambda gym: []),
+    )
+
+
+def raid_event(gym_id="scanner-gym", end=None, level=5, pokemon_id=0):
+    if end is None:
+        end = int(time.time()) + 30 * 60
+    return {"type": "raid", "message": {
+        "gym_id": gym_id,
+        "name": "Test Gym",
+        "latitude": 51.5,
+        "longitude": -0.1,
+        "end": end,
+        "level": level,
+        "pokemon_id": pokemon_id,
+    }}
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def post(hook, *events):
+    return run(hook.mad_handler(Request(list(events))))
+
+
+def queued(hook):
+    messages = []
+    while not hook.queue.empty():
+        messages.append(hook.queue.get_nowait())
+    return messages
+
+
+def test_string_fields_are_normalised():
+    hook = webhook.Webhook(make_cog())
+    end = int(time.time()) + 30 * 60
+    response = post(hook, raid_event(end=str(end), level="5", pokemon_id="150"))
+    assert response.status == 202
+    message, = queued(hook)
+    assert (message["end"], message["level"], message["pokemon_id"]) == (end, 5, 150)
+    assert webhook.event_time(message) == datetime.datetime.fromtimestamp(end, pytz.utc)
+
+
+def test_invalid_events_are_skipped():
+    hook = webhook.Webhook(make_cog())
+    response = post(hook, raid_event(end="soon"), {"type": "raid", "message": None}, raid_event())
+    assert response.status == 202
+    assert len(queued(hook)) == 1
+    assert hook.stats["invalid"] == 2
+
+
+def test_duplicates_are_dropped_until_the_boss_is_known():
+    hook = webhook.Webhook(make_cog())
+    end = int(time.time()) + 30 * 60
+    post(hook, raid_event(end=end), raid_event(end=str(end)))
+    post(hook, raid_event(end=end, pokemon_id=150))
+    post(hook, raid_event(end=end, pokemon_id=150), raid_event(end=end))
+    assert [message["pokemon_id"] for message in queued(hook)] == [0, 150]
+    assert hook.stats["duplicates"] == 3
+
+
+def test_full_queue_answers_503():
+    hook = webhook.Webhook(make_cog())
+    hook.queue = asyncio.Queue(maxsize=1)
+    response = post(hook, raid_event(gym_id="a"), raid_event(gym_id="b"))
+    assert response.status == 503
+    assert response.headers["Retry-After"] == str(webhook.RETRY_AFTER)
+    assert hook.stats["dropped"] == 1
+    queued(hook)
+    # The rejected event wasn't recorded, so the resend gets in.
+    assert post(hook, raid_event(gym_id="b")).status == 202
+    assert [message["gym_id"] for message in queued(hook)] == ["b"]
+
+
+def test_failed_batch_lets_resends_through():
+    hook = webhook.Webhook(make_cog(SimpleNamespace(rollback=lambda: None)))
+
+    async def process(batch):
+        raise RuntimeError("database went away")
+    hook.process = process
+
+    event = raid_event()
+    post(hook, event)
+    run(hook.handle(queued(hook)))
+    assert hook.stats["errors"] == 1
+    post(hook, event)
+    assert len(queued(hook)) == 1
+    assert hook.stats["duplicates"] == 0
+
+
+def test_find_raid():
+    now = datetime.datetime.utcnow()
+    early = SimpleNamespace(despawn_time=now - datetime.timedelta(hours=3))
+    current = SimpleNamespace(despawn_time=now + datetime.timedelta(minutes=5))
+    assert webhook.find_raid([early, current], pytz.utc.localize(now)) is current
+    assert webhook.find_raid([early], pytz.utc.localize(now)) is None
+
+
+def test_process_creates_then_hatches(session, monkeypatch):
+    gym = models.Gym(id="test-gym", title="Test Gym", location=from_shape(Point(-0.1, 51.5), srid=4326), ex=False)
+    pokemon = models.Pokemon(id=99150, name="Mewtwo", raid_level=5)
+    session.add_all([gym, pokemon])
+    session.flush()
+
+    broadcast, hatched = [], []
+
+    async def broadcast_raid(cog, raid):
+        broadcast.append(raid)
+
+    async def hatch_raid(cog, raid, pokemon):
+        hatched.append((raid, pokemon))
+    monkeypatch.setattr(utils, "broadcast_raid", broadcast_raid)
+    monkeypatch.setattr(utils, "hatch_raid", hatch_raid)
+
+    hook = webhook.Webhook(make_cog(session))
+    hook.gyms.add("test-gym", 51.5, -0.1)
+    end = int(time.time()) + 30 * 60
+    egg = raid_event(gym_id="test-gym", end=end)["message"]
+    # The same egg twice, and once more with a slightly different end.
+    run(hook.process([egg, dict(egg), dict(egg, end=end + 60)]))
+    raid, = broadcast
+    assert raid.gym_id == "test-gym"
+    assert raid.pokemon is None
+    assert session.query(models.Raid).count() == 1
+
+    boss = dict(egg, pokemon_id=99150)
+    run(hook.process([boss]))
+    assert hatched == [(raid, pokemon)]
+    assert session.query(models.Raid).count() == 1
+    assert hook.stats["created"] == 1
+    assert hook.stats["hatched"] == 1